@@ -0,0 +1,94 @@
+import os
+
+# Stand-ins for music functions that don't need the mixer to answer.
+# Until something has been played nothing is busy, and there's nothing to
+# stop, pause or unload
+IDLE = {
+    "get_busy": False,
+    "get_pos": -1,
+    "pause": None,
+    "stop": None,
+    "unload": None,
+    "unpause": None,
+}
+
+
+class AudioDisabled(Exception):
+    pass
+
+
+class PygameBackend:
+    # The real thing. A backend has a `music` with the same interface as
+    # pygame.mixer.music, the exception type that raises as `error`, and
+    # quit to shut it down
+    def __init__(self):
+        # Don't print pygame's banner in the middle of the prompt
+        os.environ.setdefault("PYGAME_HIDE_SUPPORT_PROMPT", "1")
+        import pygame.mixer
+
+        pygame.mixer.init()
+        self._mixer = pygame.mixer
+        self.music = pygame.mixer.music
+        self.error = pygame.error
+
+    def quit(self):
+        self.music.unload()
+        self._mixer.quit()
+
+
+class Audio:
+    # The backend is only created, which for pygame means importing it and
+    # starting the mixer, the first time something actually needs to make
+    # a sound. Commands like `ls` or `queue save` never pay for it
+    backend = PygameBackend  # Called with no arguments to create it
+    _active = None
+    _disabled = False
+
+    @classmethod
+    def use(cls, backend):
+        # Swaps in another backend, e.g. simaudio.SimulatedBackend
+        cls.quit()
+        cls.backend = backend
+        cls._active = None
+
+    @classmethod
+    def disable(cls):
+        # For headless runs, where anything that needs audio should fail
+        # rather than open the sound device
+        cls._disabled = True
+
+    @classmethod
+    def started(cls):
+        return cls._active is not None
+
+    @classmethod
+    def start(cls):
+        if cls._disabled:
+            raise AudioDisabled("Audio isn't available in headless mode")
+        if cls._active is None:
+            cls._active = cls.backend()
+        return cls._active.music
+
+    @classmethod
+    def error(cls):
+        # The backend's exception type, for except clauses. Only needed
+        # after a call that would have started the backend anyway
+        cls.start()
+        return cls._active.error
+
+    @classmethod
+    def quit(cls):
+        if cls._active is not None:
+            cls._active.quit()
+
+
+class LazyMusic:
+    # Drop-in for pygame.mixer.music that goes to the current backend
+    def __getattr__(self, name):
+        if not Audio.started() and name in IDLE:
+            value = IDLE[name]
+            return lambda *args: value
+        return getattr(Audio.start(), name)
+
+
+music = LazyMusic()
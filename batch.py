@@ -0,0 +1,178 @@
+import io
+import sys
+from contextlib import redirect_stdout
+
+import macros
+import smp_queue as q
+from audio import AudioDisabled
+from lexer import Command, parse, split
+from library import Library
+from metadata import Metadata, try_read_track
+from player import Player
+from prefix import PrefixIndex
+from settings import Settings
+from smp_queue import Q_CMDS
+
+# Runs scripts for `exec` and at startup. The whole script is parsed
+# before anything runs, runs of `queue add` are merged into one bulk add,
+# and nothing ever prompts: problems are collected and reported by line
+# number once the script is done
+
+
+def read_script(lines, cmds):
+    # Returns (line number, line, Command) for every command in the
+    # script. Blank lines and lines starting with # are skipped
+    entries = []
+    for lineno, line in enumerate(lines, start=1):
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        words = split(line)
+        if macros.resolve(words[0], cmds) == "macro":
+            # Semicolons in a macro definition belong to the macro
+            command = Command(words[0], tuple(macros.macro_args(line)))
+            entries.append((lineno, line, command))
+            continue
+        for command in parse(line):
+            entries.append((lineno, line, command))
+    return entries
+
+
+def run_script(path, cmds):
+    # Returns the problems found, or None if the script couldn't be read
+    try:
+        with open(path) as f:
+            lines = f.read().splitlines()
+    except OSError as e:
+        print(f"Couldn't read {path}: {e.strerror}")
+        return None
+    return run_lines(lines, path, cmds)
+
+
+def run_lines(lines, source, cmds):
+    # Returns a list of (line number, line, message) for everything that
+    # went wrong, after printing them
+    entries = read_script(lines, cmds)
+    errors = []
+    adds = []  # (line number, line, songs) waiting to be added
+    autocomplete = Settings.autocomplete
+    stdin = sys.stdin
+    # Autocomplete only asks which option you meant at level 2, and
+    # anything else that wants input gets an EOFError straight away
+    Settings.autocomplete = min(autocomplete, 1)
+    sys.stdin = io.StringIO()
+    try:
+        for lineno, line, command in entries:
+            steps = macros.plan(command.name, command.args, cmds)
+            if steps is None:
+                message = "Recursive or cyclical macros are not allowed"
+                errors.append((lineno, line, message))
+                continue
+            for name, args in steps:
+                if is_add(name, args):
+                    adds.append((lineno, line, args[1:]))
+                    continue
+                add_songs(adds, errors)
+                adds = []
+                run_step(cmds, lineno, line, name, args, errors)
+        add_songs(adds, errors)
+    finally:
+        Settings.autocomplete = autocomplete
+        sys.stdin = stdin
+    if errors:
+        print(f"{len(errors)} problems in {source}:")
+        for lineno, line, message in errors:
+            print(f"    line {lineno} ({line}): {message}")
+    return errors
+
+
+def is_add(name, args):
+    # A bare `queue add` is left to run on its own, so it's reported
+    return (
+        name == "queue"
+        and len(args) > 1
+        and macros.resolve(args[0], Q_CMDS) == "add"
+    )
+
+
+class Tee(io.TextIOBase):
+    # Passes output straight through while keeping the last message, so a
+    # command that fails can be reported with it. Help is printed in one
+    # go, so a command that shows its help is reported with the usage line
+    def __init__(self, stream):
+        self.stream = stream
+        self.last = ""
+
+    def write(self, text):
+        if text.strip():
+            self.last = text
+        return self.stream.write(text)
+
+    def flush(self):
+        self.stream.flush()
+
+    def failure(self):
+        return self.last.strip().split("\n")[0].strip() or "Failed"
+
+
+def run_step(cmds, lineno, line, name, args, errors):
+    if name not in cmds:
+        matches = PrefixIndex.of(cmds).matches(name)
+        if len(matches) != 1:
+            message = (
+                f"Ambiguous command, could be one of {', '.join(matches)}"
+                if matches
+                else f"Invalid command {name}"
+            )
+            errors.append((lineno, line, message))
+            return
+        name = matches[0]
+    if name != "macro":
+        # Like at the prompt, macro names can't stand in for arguments to
+        # `macro` itself, or `macro save m` would save m's body instead
+        args = [Player.macros.get(arg, arg) for arg in args]
+    output = Tee(sys.stdout)
+    try:
+        with redirect_stdout(output):
+            result = cmds[name](*args)
+        if result is False:
+            errors.append((lineno, line, output.failure()))
+    except AudioDisabled as e:
+        errors.append((lineno, line, str(e)))
+    except EOFError:
+        errors.append((lineno, line, "Needs input, which scripts can't give"))
+    except Exception as e:
+        errors.append((lineno, line, f"{type(e).__name__}: {e}"))
+
+
+def add_songs(adds, errors):
+    # Every song is looked up in the same library index and all their
+    # lengths are read in one go
+    if not adds:
+        return
+    index = Library.index()
+    songs = {}  # song -> (line number, line) it was added on
+    for lineno, line, args in adds:
+        for arg in args:
+            song = index.unique(arg)
+            if song is None:
+                message = (
+                    f"Ambiguous song {arg}"
+                    if index.count(arg)
+                    else f"Song not found: {arg}"
+                )
+                errors.append((lineno, line, message))
+            elif song in songs or song in Player.queue:
+                errors.append((lineno, line, f"{song} is already queued"))
+            else:
+                songs[song] = (lineno, line)
+    # enqueue would raise on the first file mutagen can't read, after some
+    # songs had already gone in. Those files are reported and left out
+    lengths = Metadata.durations(
+        (Settings.music_dir / song for song in songs), try_read_track
+    )
+    for song, (lineno, line) in list(songs.items()):
+        if not lengths[str(Settings.music_dir / song)]:
+            errors.append((lineno, line, f"Couldn't read {song}"))
+            del songs[song]
+    q.enqueue(songs)
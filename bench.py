@@ -0,0 +1,243 @@
+#!/usr/bin/env python
+import argparse
+import importlib.machinery
+import importlib.util
+import io
+import json
+import os
+import platform
+import random
+import struct
+import subprocess
+import sys
+import tempfile
+from contextlib import redirect_stdout
+from pathlib import Path
+from time import perf_counter, sleep
+
+# Benchmarks for the paths that get slow with big libraries. A synthetic
+# library of tiny tagged WAV files and a set of playlists is generated in
+# a temporary directory for each scale, every path is timed against it,
+# and the results are written as JSON so runs on different commits can be
+# compared, e.g.
+#     python3 bench.py --scales 1000,10000 --output before.json
+SCALES = (1_000, 10_000, 100_000)
+PLAYLISTS = 20
+REPEATS = 3  # Each timing is the best of this many runs
+LOOKUPS = 1_000  # Song lookups per ac_songs run
+EDITS = 50  # Songs swapped, removed, renamed or deleted per run
+WORDS = (
+    "red blue green gold silver night day summer winter river stone "
+    "fire rain heart road light dream city ocean star"
+).split()
+RATE = 8000
+FRAMES = RATE // 20  # 50ms of silence, just enough to have a length
+REPO = Path(__file__).resolve().parent
+
+
+def id3_frame(frame_id, text):
+    # ID3v2.3 text frame, latin-1 encoded
+    body = b"\0" + text.encode("latin-1")
+    return frame_id + struct.pack(">IH", len(body), 0) + body
+
+
+def wav_bytes(title, artist):
+    fmt = struct.pack("<HHIIHH", 1, 1, RATE, RATE, 1, 8)
+    tags = id3_frame(b"TIT2", title) + id3_frame(b"TPE1", artist)
+    # The ID3 size is "syncsafe", seven bits to a byte
+    size = bytes((len(tags) >> shift) & 0x7F for shift in (21, 14, 7, 0))
+    id3 = b"ID3\3\0\0" + size + tags
+    if len(id3) % 2:
+        id3 += b"\0"
+    chunks = (
+        b"fmt " + struct.pack("<I", len(fmt)) + fmt,
+        b"data" + struct.pack("<I", FRAMES) + b"\x80" * FRAMES,
+        b"id3 " + struct.pack("<I", len(id3)) + id3,
+    )
+    body = b"WAVE" + b"".join(chunks)
+    return b"RIFF" + struct.pack("<I", len(body)) + body
+
+
+def generate(root, count, rng):
+    music_dir = root / f"music-{count}"
+    playlist_dir = music_dir / "playlists"
+    playlist_dir.mkdir(parents=True)
+    songs = []
+    for idx in range(count):
+        title = f"{rng.choice(WORDS)} {rng.choice(WORDS)} {idx}"
+        artist = f"{rng.choice(WORDS)} {rng.choice(WORDS)}"
+        song = f"{title}.wav"
+        (music_dir / song).write_bytes(wav_bytes(title, artist))
+        songs.append(song)
+    return music_dir, playlist_dir, songs
+
+
+def load_smp():
+    # smp is a script rather than a module, so it's loaded by hand
+    loader = importlib.machinery.SourceFileLoader("smp", str(REPO / "smp"))
+    spec = importlib.util.spec_from_loader("smp", loader)
+    module = importlib.util.module_from_spec(spec)
+    loader.exec_module(module)
+    return module
+
+
+def best(func, repeats=REPEATS, setup=None):
+    # Fastest of `repeats` runs, with output thrown away
+    times = []
+    for _ in range(repeats):
+        if setup is not None:
+            setup()
+        with redirect_stdout(io.StringIO()):
+            start = perf_counter()
+            func()
+            times.append(perf_counter() - start)
+    return min(times)
+
+
+def run_scale(smp, root, count, rng):
+    from audio import Audio
+    from library import LIBRARY_PATH, Library
+    from metadata import Metadata
+    from player import Player
+    from playlists import write_playlist
+    from settings import Settings
+    from smp_common import ac_songs
+
+    q = smp.q
+    results = {}
+    start = perf_counter()
+    music_dir, playlist_dir, songs = generate(root, count, rng)
+    results["generate"] = perf_counter() - start
+    Settings.music_dir = music_dir
+    Settings.playlist_dir = playlist_dir
+    Settings.autocomplete = 1
+    Audio.disable()
+
+    def cold_library():
+        LIBRARY_PATH.unlink(missing_ok=True)
+        Library._music_dir = None
+        Library._mtime = None
+
+    results["gen_files (cold)"] = best(smp.gen_files, setup=cold_library)
+    results["gen_files (warm)"] = best(smp.gen_files)
+
+    # Names without the extension, so some of them are ambiguous
+    sample = rng.sample(songs, min(LOOKUPS, count))
+    prefixes = [song[: len(song) - 4] for song in sample]
+    results[f"ac_songs x{len(prefixes)}"] = best(
+        lambda: [ac_songs(1, prefix) for prefix in prefixes]
+    )
+    results["find"] = best(lambda: smp.find(*rng.sample(WORDS, 3)))
+    results["find -f"] = best(lambda: smp.find("-f", "silvr rivr"))
+
+    # One playlist with everything, the rest with a random slice each
+    write_playlist(playlist_dir / "all.smpl", songs)
+    size = max(1, count // PLAYLISTS)
+    for idx in range(PLAYLISTS - 1):
+        mix = rng.sample(songs, size)
+        write_playlist(playlist_dir / f"mix{idx}.smpl", mix)
+
+    def wait_for_info():
+        while Player.info_pending:
+            q.apply_info()
+            sleep(0.001)
+
+    # Song lengths aren't cached yet the first time round, so the first
+    # load reads every file in the background
+    start = perf_counter()
+    with redirect_stdout(io.StringIO()):
+        q.load("all")
+        results["queue load (cold)"] = perf_counter() - start
+        wait_for_info()
+    results["queue load (lengths read)"] = perf_counter() - start
+    results["queue load (warm)"] = best(lambda: q.load("all"))
+    results["Metadata.durations (cached)"] = best(
+        lambda: Metadata.durations(music_dir / song for song in songs)
+    )
+
+    Player.playing_queue = True
+    Player.q_idx = count // 2
+    Player.cur_song = music_dir / songs[count // 2 - 1]
+    Player.duration = 1
+    results["queue status x100"] = best(
+        lambda: [q.status() for _ in range(100)]
+    )
+    Player.playing_queue = False
+
+    pairs = [rng.sample(songs, 2) for _ in range(EDITS)]
+    results[f"queue swap x{EDITS}"] = best(
+        lambda: [q.swap(first, second) for first, second in pairs]
+    )
+    removed = rng.sample(songs, EDITS)
+    results[f"queue remove {EDITS}"] = best(
+        lambda: q.remove(*removed), setup=lambda: q.load("all")
+    )
+
+    renamed = rng.sample(songs, EDITS)
+    args = []
+    for song in renamed:
+        args += [song, f"renamed {song[:-4]}"]
+    results[f"rename {EDITS}"] = best(lambda: smp.rename(*args), repeats=1)
+    deleted = [f"renamed {song}" for song in renamed]
+    results[f"delete {EDITS}"] = best(lambda: smp.delete(*deleted), repeats=1)
+    return results
+
+
+def commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=REPO,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Benchmark smp")
+    arg_parser.add_argument(
+        "--scales",
+        default=",".join(map(str, SCALES)),
+        help="comma separated library sizes (default: %(default)s)",
+    )
+    arg_parser.add_argument(
+        "--output", default="bench.json", help="where to write the results"
+    )
+    arg_parser.add_argument("--seed", type=int, default=0)
+    options = arg_parser.parse_args()
+    scales = [int(scale) for scale in options.scales.split(",")]
+
+    with tempfile.TemporaryDirectory(prefix="smp-bench-") as tmp:
+        # smp keeps its library index and metadata cache under ~/.config,
+        # so point that somewhere disposable before importing anything
+        root = Path(tmp)
+        os.environ["HOME"] = str(root)
+        (root / ".config" / "smp").mkdir(parents=True)
+        sys.path.insert(0, str(REPO))
+        smp = load_smp()
+        report = {
+            "commit": commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "seed": options.seed,
+            "results": [],
+        }
+        for count in scales:
+            rng = random.Random(options.seed)
+            results = run_scale(smp, root, count, rng)
+            print(f"{count} songs:")
+            for name, secs in results.items():
+                print(f"    {name:<30} {secs * 1000:10.2f} ms")
+                report["results"].append(
+                    {"scale": count, "path": name, "seconds": secs}
+                )
+    with open(options.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {options.output}")
+
+
+if __name__ == "__main__":
+    main()
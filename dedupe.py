@@ -0,0 +1,156 @@
+import os
+from collections import Counter, defaultdict
+from itertools import combinations
+
+from loudness import decode
+from metadata import Metadata, stat_key, try_read_track
+from stats import Stats
+
+RATE = 11025  # Plenty for the bands fingerprints look at
+FRAME = 0.37  # Seconds per fingerprint frame
+HOPS = 8  # Frames start every FRAME / HOPS, so copies can't be far out
+LIMIT = 60  # Seconds of each song that are fingerprinted
+BANDS = 33  # Energy bands between 300Hz and 2kHz, giving 32 bits a frame
+SAMPLE = 8  # Only frames whose value is a multiple of this are indexed
+MAX_BUCKET = 50  # Values shared by more songs than this are too common
+MIN_SHARED = 2  # Indexed values two songs need in common to be compared
+MAX_SHIFT = 8  # Frames that copies are allowed to be out of line by
+MAX_ERRORS = 0.25  # Fraction of bits that can differ, unrelated songs ~0.5
+MAX_LENGTH_DIFF = 3  # Seconds, so edits and extended mixes aren't matched
+WORKERS = max(1, (os.cpu_count() or 1) - 1)
+
+
+def fingerprint(path):
+    # Runs in a worker process. Returns the song's fingerprint, one 32 bit
+    # value per frame of its first LIMIT seconds, as bytes. Each bit is
+    # whether the energy difference between two neighbouring bands went up
+    # or down since the last frame, which survives re-encoding, a change
+    # of bitrate or format and volume changes. None if it can't be decoded
+    import numpy as np
+
+    chunks = decode(path, 1, RATE)
+    if chunks is None:
+        return None
+    parts = []
+    length = 0
+    try:
+        for rate, samples in chunks:
+            parts.append(samples.mean(axis=1, dtype=np.float32))
+            length += len(samples)
+            if length >= LIMIT * rate:
+                break
+    except (OSError, EOFError):
+        return None
+    finally:
+        chunks.close()
+    if not parts:
+        return b""
+    mono = np.concatenate(parts)[: LIMIT * rate]
+    size = int(FRAME * rate)
+    if len(mono) < size:
+        return b""
+    frames = np.lib.stride_tricks.sliding_window_view(mono, size)
+    frames = frames[:: size // HOPS]
+    power = np.abs(np.fft.rfft(frames * np.hanning(size), axis=1)) ** 2
+    # Bands are spaced logarithmically, like hearing
+    freqs = np.fft.rfftfreq(size, 1 / rate)
+    edges = np.searchsorted(freqs, np.geomspace(300, 2000, BANDS + 1))
+    energy = np.add.reduceat(power, edges, axis=1)[:, :BANDS]
+    change = energy[:, :-1] - energy[:, 1:]
+    bits = np.diff(change, axis=0) > 0
+    return np.packbits(bits, axis=1).view(">u4").astype("<u4").tobytes()
+
+
+def bit_errors(first, second):
+    # Fraction of bits that differ, at whichever alignment is best
+    import numpy as np
+
+    best = 1.0
+    for shift in range(-MAX_SHIFT, MAX_SHIFT + 1):
+        a = first[max(shift, 0) :]
+        b = second[max(-shift, 0) :]
+        size = min(len(a), len(b))
+        if not size:
+            continue
+        xor = np.bitwise_xor(a[:size], b[:size])
+        errors = np.unpackbits(xor.view(np.uint8)).sum()
+        best = min(best, errors / (32 * size))
+    return best
+
+
+def fingerprints(paths, progress=None):
+    # {str(path): fingerprint as a uint32 array}. Cached fingerprints are
+    # used as long as the file hasn't changed, the rest are worked out in
+    # parallel and cached. Files that can't be decoded are left out
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+
+    import numpy as np
+
+    found = Metadata.fingerprints(paths)
+    stale = [str(path) for path in paths if str(path) not in found]
+    if stale:
+        # Spawned rather than forked, see Loudness.pool
+        with ProcessPoolExecutor(
+            max_workers=WORKERS,
+            mp_context=multiprocessing.get_context("spawn"),
+        ) as pool:
+            futures = {pool.submit(fingerprint, path): path for path in stale}
+            entries = {}
+            for done, future in enumerate(as_completed(futures), 1):
+                path = futures[future]
+                try:
+                    data = future.result()
+                except Exception:
+                    data = None
+                if data is not None:
+                    found[path] = data
+                    entries[path] = (stat_key(path), data)
+                if progress is not None:
+                    progress(done, len(stale))
+        Metadata.store_fingerprints(entries)
+        Stats.count("songs fingerprinted", len(entries))
+    return {
+        path: np.frombuffer(data, "<u4") for path, data in found.items()
+    }
+
+
+def duplicates(paths, progress=None):
+    # Lists of songs that sound the same, from fingerprints that share
+    # enough values and then mostly match bit for bit
+    prints = fingerprints(paths, progress)
+    lengths = Metadata.durations(prints, try_read_track)
+    # Without a length there's no telling an edit from the original, so
+    # files mutagen can't read are left out
+    prints = {path: values for path, values in prints.items() if lengths[path]}
+    index = defaultdict(list)
+    for path, values in prints.items():
+        for value in set(values[values % SAMPLE == 0].tolist()) - {0}:
+            index[value].append(path)
+    shared = Counter()
+    for songs in index.values():
+        if 1 < len(songs) <= MAX_BUCKET:
+            shared.update(combinations(sorted(songs), 2))
+    parent = {}
+
+    def root(path):
+        while parent.get(path, path) != path:
+            path = parent[path]
+        return path
+
+    for (first, second), count in shared.items():
+        if count < MIN_SHARED:
+            continue
+        if abs(lengths[first] - lengths[second]) > MAX_LENGTH_DIFF:
+            continue
+        if root(first) == root(second):
+            continue
+        if bit_errors(prints[first], prints[second]) <= MAX_ERRORS:
+            parent[root(second)] = root(first)
+    members = defaultdict(list)
+    for path in parent:
+        members[root(path)].append(path)
+    for path, songs in members.items():
+        if path not in songs:
+            songs.append(path)
+    return sorted(sorted(songs) for songs in members.values())
@@ -0,0 +1,57 @@
+from queue import Empty, Queue
+
+# How many commands can be waiting before whoever is sending them has to
+# wait for the main loop to catch up
+COMMAND_BACKLOG = 64
+
+
+class Events:
+    # Everything that should wake the main loop goes through here, so it
+    # can sleep until there's actually something to do
+    COMMAND = "command"  # A line is waiting in Commands, payload unused
+    INFO = "info"  # Background work finished, payload unused
+    FILE = "file"  # payload: the config or macros file that changed
+    _queue = Queue()
+
+    @classmethod
+    def post(cls, kind, payload=None):
+        cls._queue.put((kind, payload))
+
+    @classmethod
+    def wait(cls, timeout=None):
+        # Returns (kind, payload), or None if nothing happened before the
+        # timeout. A timeout of None waits as long as it takes
+        try:
+            return cls._queue.get(timeout=timeout)
+        except Empty:
+            return None
+
+
+class Commands:
+    # Hands lines over to the main loop. submit blocks while the backlog is
+    # full, so a fast sender (pasted input, piped scripts) is slowed down
+    # rather than having commands dropped
+    _queue = Queue(maxsize=COMMAND_BACKLOG)
+
+    @classmethod
+    def submit(cls, line):
+        cls._queue.put(line)
+        Events.post(Events.COMMAND)
+
+    @classmethod
+    def take(cls):
+        # Returns the oldest waiting line, or None if there isn't one. Every
+        # line taken has to be followed by a call to done
+        try:
+            return cls._queue.get_nowait()
+        except Empty:
+            return None
+
+    @classmethod
+    def done(cls):
+        cls._queue.task_done()
+
+    @classmethod
+    def wait(cls):
+        # Blocks until every submitted line has been dealt with
+        cls._queue.join()
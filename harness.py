@@ -0,0 +1,247 @@
+#!/usr/bin/env python
+import argparse
+import io
+import json
+import os
+import random
+import sys
+import tempfile
+from contextlib import redirect_stdout
+from pathlib import Path
+from time import perf_counter
+
+from bench import REPO, load_smp
+
+# Replays a scripted stream of commands through smp's main loop with the
+# simulated audio backend on a virtual clock, so playback can be tested
+# and timed without a sound device, and a run through a whole album takes
+# a moment. Scripts have one command per line, prefixed with the time in
+# seconds it should be entered at:
+#     0 queue add song000 song001 song002
+#     0 queue play
+#     12.5 seek 1:00
+# Reports how long each command took to handle (wall time), how long
+# after each command a song started (virtual time), and the gap between
+# one song ending and the next one starting
+DEFAULT_SCRIPT = """\
+0 queue add song000 song001 song002 song003 song004 song005
+0 queue play
+10 seek 20
+40 pause
+45 unpause
+50 queue next
+100 repeat
+200 queue gapless
+400 loop
+420 loop
+"""
+
+
+def read_script(text):
+    steps = []
+    for line in text.splitlines():
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        at, _, command = line.partition(" ")
+        steps.append((float(at), command.strip()))
+    steps.sort(key=lambda step: step[0])
+    return steps
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+class Harness:
+    def __init__(self, root, songs, length, jitter, seed):
+        # Imported here because smp's modules work out where ~/.config is
+        # when they're imported, and main has to point HOME away first
+        from audio import Audio
+        from metadata import Metadata, stat_key
+        from player import Player
+        from settings import Settings
+        from simaudio import SimulatedBackend, VirtualClock
+
+        music_dir = root / "music"
+        music_dir.mkdir()
+        lengths = {}
+        for idx in range(songs):
+            path = music_dir / f"song{idx:03}.mp3"
+            path.touch()
+            lengths[str(path)] = length
+        # Lengths go straight into the metadata cache, since the files
+        # themselves are empty
+        Metadata.store(
+            {path: (stat_key(path), length, "") for path in lengths}
+        )
+        Settings.music_dir = music_dir
+        Settings.playlist_dir = root
+        Settings.autocomplete = 1
+        Player.macros = {}
+        Player.volume = Settings.default_volume = 100
+        self.clock = VirtualClock()
+        self.backend = SimulatedBackend(self.clock, lengths)
+        Audio.use(lambda: self.backend)
+        self.smp = load_smp()
+        self.rng = random.Random(seed)
+        self.jitter = jitter
+        self.commands = []
+
+    def drain(self):
+        # Handles every event that's waiting, like the main loop would
+        from events import Events
+
+        while (event := Events.wait(0)) is not None:
+            self.smp.tick(event)
+
+    def run(self, steps, until):
+        from events import Commands
+
+        while True:
+            for at, command in self.due(steps):
+                logged = len(self.backend.log)
+                start = perf_counter()
+                Commands.submit(command)
+                self.drain()
+                self.commands.append(
+                    {
+                        "time": at,
+                        "command": command,
+                        "latency": perf_counter() - start,
+                        "started": self.started_after(logged, at),
+                    }
+                )
+            timeout = self.smp.next_wakeup()
+            if not steps and (timeout is None or self.clock() >= until):
+                break
+            wake = steps[0][0] if steps else until
+            if timeout is not None:
+                # A real sleep never wakes up exactly on time
+                late = self.rng.uniform(0, self.jitter)
+                wake = min(wake, self.clock() + timeout + late)
+            self.clock.advance(wake - self.clock())
+            if timeout is not None and (not steps or wake < steps[0][0]):
+                self.smp.tick(None)
+            self.drain()
+
+    def due(self, steps):
+        while steps and steps[0][0] <= self.clock():
+            yield steps.pop(0)
+
+    def started_after(self, idx, at):
+        # Virtual seconds between a command and the next song starting,
+        # if the command is what started it
+        for time, kind, _ in self.backend.log[idx:]:
+            if kind == "start":
+                return time - at
+        return None
+
+    def gaps(self):
+        # Time between each song ending on its own and the next starting
+        gaps = []
+        ended = None
+        for time, kind, path in self.backend.log:
+            if kind == "end":
+                ended = (time, path)
+            elif kind == "start" and ended is not None:
+                gaps.append(
+                    {
+                        "from": Path(ended[1]).name,
+                        "to": Path(path).name,
+                        "at": ended[0],
+                        "gap": time - ended[0],
+                    }
+                )
+                ended = None
+            elif kind == "stop":
+                ended = None
+        return gaps
+
+
+def report(harness):
+    latencies = [command["latency"] for command in harness.commands]
+    print(f"{len(latencies)} commands")
+    if latencies:
+        mean = sum(latencies) / len(latencies)
+        print(
+            f"    handling time: mean {mean * 1000:.2f}ms,"
+            f" p95 {percentile(latencies, 0.95) * 1000:.2f}ms,"
+            f" max {max(latencies) * 1000:.2f}ms"
+        )
+    for command in harness.commands:
+        if command["started"] is not None:
+            print(
+                f"    {command['time']:8.2f}s {command['command']}: song"
+                f" started after {command['started'] * 1000:.1f}ms"
+            )
+    gaps = harness.gaps()
+    print(f"{len(gaps)} transitions")
+    for gap in gaps:
+        print(
+            f"    {gap['at']:8.2f}s {gap['from']} -> {gap['to']}:"
+            f" {gap['gap'] * 1000:.1f}ms gap"
+        )
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(
+        description="Replay a command script against simulated audio"
+    )
+    arg_parser.add_argument(
+        "script",
+        nargs="?",
+        help="command script, a built-in demo if not given",
+    )
+    arg_parser.add_argument("--songs", type=int, default=10)
+    arg_parser.add_argument(
+        "--length", type=float, default=60, help="song length in seconds"
+    )
+    arg_parser.add_argument(
+        "--jitter",
+        type=float,
+        default=0.005,
+        help="most the main loop can oversleep by, in seconds",
+    )
+    arg_parser.add_argument(
+        "--until",
+        type=float,
+        default=3600,
+        help="virtual seconds to stop at if songs are still playing",
+    )
+    arg_parser.add_argument("--seed", type=int, default=0)
+    arg_parser.add_argument("--output", help="write the results as JSON")
+    arg_parser.add_argument(
+        "--verbose", action="store_true", help="show smp's own output"
+    )
+    options = arg_parser.parse_args()
+    if options.script:
+        steps = read_script(Path(options.script).read_text())
+    else:
+        steps = read_script(DEFAULT_SCRIPT)
+
+    with tempfile.TemporaryDirectory(prefix="smp-harness-") as tmp:
+        # Keep smp's library index and metadata cache out of ~/.config
+        root = Path(tmp)
+        os.environ["HOME"] = str(root)
+        (root / ".config" / "smp").mkdir(parents=True)
+        sys.path.insert(0, str(REPO))
+        harness = Harness(
+            root, options.songs, options.length, options.jitter, options.seed
+        )
+        output = sys.stdout if options.verbose else io.StringIO()
+        with redirect_stdout(output):
+            harness.run(steps, options.until)
+    report(harness)
+    if options.output:
+        with open(options.output, "w") as f:
+            json.dump(
+                {"commands": harness.commands, "transitions": harness.gaps()},
+                f,
+                indent=2,
+            )
+
+
+if __name__ == "__main__":
+    main()
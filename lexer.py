@@ -0,0 +1,92 @@
+import re
+from collections import namedtuple
+
+# The smp command language: commands are separated by `;` and made of
+# words separated by whitespace. Quotes (either kind) keep spaces and
+# semicolons in a word, and a backslash takes the next character as it is.
+# Empty commands, like the one between the semicolons in `;;`, are skipped
+Command = namedtuple("Command", "name args")
+
+# A quote that's never closed runs to the end of the line
+WORD = r"""(?:[^\s;"'\\]+|\\.?|"(?:[^"\\]|\\.)*"?|'(?:[^'\\]|\\.)*'?)+"""
+TOKEN = re.compile(rf"\s+|(;)|({WORD})", re.DOTALL)
+# For lines where semicolons aren't separators, e.g. `macro add`
+PLAIN_WORD = re.compile(WORD.replace(";", ""), re.DOTALL)
+PIECE = re.compile(
+    r"""\\(.?)|"((?:[^"\\]|\\.)*)"?|'((?:[^'\\]|\\.)*)'?""", re.DOTALL
+)
+ESCAPE = re.compile(r"\\(.?)", re.DOTALL)
+
+
+def _unquote_piece(match):
+    escaped, double, single = match.groups()
+    if escaped is not None:
+        return escaped
+    return ESCAPE.sub(r"\1", double if double is not None else single)
+
+
+def unquote(word):
+    # Most words have nothing to unquote, so don't bother with them
+    if "\\" not in word and '"' not in word and "'" not in word:
+        return word
+    return PIECE.sub(_unquote_piece, word)
+
+
+def parse(text):
+    # Returns a list of Commands, in one pass over the text
+    commands = []
+    words = []
+    for match in TOKEN.finditer(text):
+        separator, word = match.groups()
+        if word is not None:
+            words.append(unquote(word))
+        elif separator and words:
+            commands.append(Command(words[0], tuple(words[1:])))
+            words = []
+    if words:
+        commands.append(Command(words[0], tuple(words[1:])))
+    return commands
+
+
+def split(text):
+    # Like parse, but semicolons are just part of words
+    return [unquote(word) for word in PLAIN_WORD.findall(text)]
+
+
+def split_head(text, count):
+    # The first `count` words, unquoted, and the text after them exactly
+    # as it was written
+    words = []
+    end = 0
+    for match in PLAIN_WORD.finditer(text):
+        if len(words) == count:
+            break
+        words.append(unquote(match.group()))
+        end = match.end()
+    return words, text[end:].strip()
+
+
+if __name__ == "__main__":
+    # Throughput benchmark: python3 lexer.py [lines]
+    from sys import argv
+    from time import perf_counter
+
+    count = int(argv[1]) if len(argv) > 1 else 100_000
+    samples = [
+        "queue add song1 song2 song3",
+        'play "a song with spaces"; volume 50',
+        r"macro add m queue add it\'s; queue play",
+        "seek 1:30;; forward 10; queue status",
+        "queue add " + " ".join(f"track{i}" for i in range(50)),
+    ]
+    for sample in samples:
+        lines = [sample] * count
+        start = perf_counter()
+        for line in lines:
+            parse(line)
+        elapsed = perf_counter() - start
+        size = len(sample) * count / 1e6
+        print(
+            f"{sample[:40]!r:44} {count / elapsed:>12,.0f} lines/s"
+            f" {size / elapsed:>8.1f} MB/s"
+        )
@@ -0,0 +1,129 @@
+import json
+import os
+from pathlib import Path
+from time import perf_counter
+
+from prefix import PrefixIndex
+from settings import Settings
+from stats import Stats
+
+CONFIG_DIR = Path("~/.config/smp").expanduser()
+LIBRARY_PATH = CONFIG_DIR / "library.json"
+SUPPORTED_TYPES = ["mp3", "ogg", "wav", "flac", "opus"]
+
+
+def scan(music_dir):
+    # One pass over the directory instead of globbing once per extension.
+    # Hidden files are skipped to match what glob("*.ext") used to return
+    with os.scandir(music_dir) as entries:
+        return sorted(
+            entry.name
+            for entry in entries
+            if not entry.name.startswith(".")
+            and Path(entry.name).suffix[1:] in SUPPORTED_TYPES
+        )
+
+
+class Library:
+    # In-memory index of the music directory, persisted to LIBRARY_PATH
+    # so a fresh session doesn't need to rescan an unchanged directory
+    songs = []  # Always kept sorted
+    version = 0  # Bumped whenever songs changes
+    _lookup = set()
+    _index = None
+    _music_dir = None
+    _mtime = None
+
+    @classmethod
+    def refresh(cls):
+        music_dir = Settings.music_dir
+        try:
+            mtime = music_dir.stat().st_mtime_ns
+        except FileNotFoundError:
+            cls._replace(music_dir, None, [])
+            return cls.songs
+        if music_dir != cls._music_dir:
+            cls._load(music_dir)
+        if mtime != cls._mtime:
+            # Adding, removing or renaming an entry updates the directory
+            # mtime, so an unchanged mtime means the index is still valid
+            start = perf_counter()
+            cls._replace(music_dir, mtime, scan(music_dir))
+            Stats.record("library scan", perf_counter() - start)
+            Stats.count("library scans")
+            cls.save()
+        return cls.songs
+
+    @classmethod
+    def index(cls):
+        # Prefix index over the song names, rebuilt whenever they change
+        cls.refresh()
+        if cls._index is None or cls._index[0] != cls.version:
+            cls._index = (cls.version, PrefixIndex(cls.songs, presorted=True))
+        return cls._index[1]
+
+    @classmethod
+    def discard(cls, song):
+        # Used when smp itself changes the directory, so we can update
+        # the index in place rather than rescanning
+        if song in cls._lookup:
+            songs = [s for s in cls.songs if s != song]
+            cls._replace(cls._music_dir, cls._mtime, songs)
+        cls._sync()
+
+    @classmethod
+    def rename(cls, old, new):
+        if old in cls._lookup:
+            songs = [s for s in cls.songs if s != old]
+            songs.append(new)
+            songs.sort()
+            cls._replace(cls._music_dir, cls._mtime, songs)
+        cls._sync()
+
+    @classmethod
+    def save(cls):
+        if cls._music_dir is None or cls._mtime is None:
+            return
+        if not CONFIG_DIR.exists():
+            CONFIG_DIR.mkdir(parents=True)
+        tmp = LIBRARY_PATH.with_suffix(".tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(
+                {
+                    "music_dir": str(cls._music_dir),
+                    "mtime": cls._mtime,
+                    "songs": cls.songs,
+                },
+                f,
+            )
+        os.replace(tmp, LIBRARY_PATH)
+
+    @classmethod
+    def _load(cls, music_dir):
+        try:
+            with open(LIBRARY_PATH, encoding="utf-8") as f:
+                saved = json.load(f)
+        except (FileNotFoundError, ValueError):
+            saved = {}
+        if saved.get("music_dir") == str(music_dir):
+            cls._replace(music_dir, saved["mtime"], saved["songs"])
+        else:
+            cls._replace(music_dir, None, [])
+
+    @classmethod
+    def _replace(cls, music_dir, mtime, songs):
+        cls._music_dir = music_dir
+        cls._mtime = mtime
+        cls.songs = songs
+        cls._lookup = set(songs)
+        cls.version += 1
+
+    @classmethod
+    def _sync(cls):
+        # Our own change bumped the directory mtime, record it so the next
+        # refresh doesn't throw the updated index away
+        try:
+            cls._mtime = cls._music_dir.stat().st_mtime_ns
+        except (AttributeError, FileNotFoundError):
+            cls._mtime = None
+        cls.save()
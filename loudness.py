@@ -0,0 +1,330 @@
+import os
+import re
+import shutil
+import subprocess
+import wave
+from functools import partial
+from importlib.util import find_spec
+from pathlib import Path
+from time import perf_counter
+
+from audio import music
+from metadata import Metadata, stat_key
+from player import Player
+from stats import Stats
+
+REFERENCE = -18.0  # LUFS, the ReplayGain 2.0 reference level
+RATE = 48000  # What ffmpeg resamples to, the rate K-weighting is defined at
+CHUNK = 10  # Seconds of audio decoded at a time
+SEGMENT = 0.1  # Seconds. Gating blocks are 4 segments, overlapping by 3
+WORKERS = max(1, (os.cpu_count() or 1) - 1)
+# ITU-R BS.1770 K-weighting at 48kHz, a high shelf and then a high pass,
+# as (numerator, denominator) coefficients
+K_WEIGHTING = (
+    (
+        (1.53512485958697, -2.69169618940638, 1.19839281085285),
+        (1.0, -1.69065929318241, 0.73248077421585),
+    ),
+    ((1.0, -2.0, 1.0), (1.0, -1.99004745483398, 0.99007225036621)),
+)
+GAIN_TAG = re.compile(r"\s*([+-]?\d+(?:\.\d*)?)")
+
+
+def tag_gain(path):
+    # The track gain from the file's ReplayGain tags, if it has them.
+    # Every format names it differently (TXXX:REPLAYGAIN_TRACK_GAIN,
+    # replaygain_track_gain, ----:com.apple.iTunes:replaygain_track_gain)
+    # but they all end the same way
+    import mutagen
+
+    try:
+        file = mutagen.File(path)
+    except Exception:
+        return None
+    if file is None or file.tags is None:
+        return None
+    for key, value in file.tags.items():
+        if not str(key).lower().endswith("replaygain_track_gain"):
+            continue
+        if isinstance(value, list):
+            value = value[0] if value else ""
+        if isinstance(value, bytes):
+            value = value.decode("utf-8", "replace")
+        match = GAIN_TAG.match(str(value))
+        if match:
+            return float(match.group(1))
+    return None
+
+
+def channels(path):
+    import mutagen
+
+    try:
+        return min(mutagen.File(path).info.channels, 2)
+    except Exception:
+        return 2
+
+
+def ffmpeg_chunks(path, count, rate=RATE):
+    # (rate, samples) with samples shaped (frames, channels)
+    import numpy as np
+
+    command = [shutil.which("ffmpeg"), "-v", "quiet", "-i", str(path)]
+    command += ["-map", "0:a:0", "-f", "f32le", "-ac", str(count)]
+    command += ["-ar", str(rate), "-"]
+    process = subprocess.Popen(
+        command, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE
+    )
+    frame = 4 * count
+    with process:
+        while chunk := process.stdout.read(CHUNK * rate * frame):
+            chunk = chunk[: len(chunk) - len(chunk) % frame]
+            yield rate, np.frombuffer(chunk, np.float32).reshape(-1, count)
+    if process.returncode:
+        raise OSError(f"ffmpeg couldn't decode {path}")
+
+
+def wav_chunks(path):
+    # For when there's no ffmpeg. Only PCM WAV, at whatever rate it's in
+    import numpy as np
+
+    with wave.open(str(path)) as f:
+        rate, count = f.getframerate(), f.getnchannels()
+        width = f.getsampwidth()
+        scale = 2.0 ** (8 * width - 1)
+        while chunk := f.readframes(CHUNK * rate):
+            if width == 1:
+                data = np.frombuffer(chunk, np.uint8) / 128.0 - 1
+            elif width == 3:
+                # No 24 bit dtype, so pad each sample out to 32 bits
+                raw = np.frombuffer(chunk, np.uint8).reshape(-1, 3)
+                padded = np.zeros((len(raw), 4), np.uint8)
+                padded[:, 1:] = raw
+                data = padded.view("<i4").ravel() / 2.0**31
+            else:
+                data = np.frombuffer(chunk, f"<i{width}") / scale
+            yield rate, data.reshape(-1, count)
+
+
+def decode(path, count, rate=RATE):
+    # Chunks of the track's audio, or None if nothing here can decode it.
+    # WAV chunks come at the file's own rate and channels
+    if shutil.which("ffmpeg"):
+        return ffmpeg_chunks(path, count, rate)
+    if Path(path).suffix.lower() == ".wav":
+        return wav_chunks(path)
+    return None
+
+
+def k_weights(size, rate):
+    # The K-weighting filter's power at each rfft bin of a `size` sample
+    # segment, scaled so summing (bin power * weight) gives the filtered
+    # segment's mean square. Applying the filter in the frequency domain
+    # keeps everything vectorized
+    import numpy as np
+
+    freqs = np.fft.rfftfreq(size, 1 / rate)
+    z = np.exp(-2j * np.pi * np.minimum(freqs / RATE, 0.5))
+    response = np.ones(len(freqs), complex)
+    for b, a in K_WEIGHTING:
+        response *= (b[0] + b[1] * z + b[2] * z**2) / (
+            a[0] + a[1] * z + a[2] * z**2
+        )
+    weights = np.abs(response) ** 2 * 2 / size**2
+    # DC and Nyquist only appear once in the full spectrum
+    weights[0] /= 2
+    if size % 2 == 0:
+        weights[-1] /= 2
+    return weights
+
+
+def integrated(powers):
+    # BS.1770 integrated loudness in LUFS from mean square power per
+    # segment, or None if it's all below the absolute gate
+    import numpy as np
+
+    if len(powers) >= 4:
+        blocks = np.convolve(powers, np.full(4, 0.25), "valid")
+    else:
+        blocks = np.array([powers.mean()]) if len(powers) else powers
+    with np.errstate(divide="ignore"):
+        loudness = -0.691 + 10 * np.log10(blocks)
+    gated = blocks[loudness > -70]
+    if not len(gated):
+        return None
+    relative = -0.691 + 10 * np.log10(gated.mean()) - 10
+    gated = gated[loudness[loudness > -70] > relative]
+    return -0.691 + 10 * np.log10(gated.mean())
+
+
+def analyze(path):
+    # Runs in a worker process. Returns (gain in dB or None, where it came
+    # from, seconds taken). Only the powers of 100ms segments are kept, so
+    # memory doesn't grow with the length of the track beyond that
+    import numpy as np
+
+    start = perf_counter()
+    gain = tag_gain(path)
+    if gain is not None:
+        return gain, "tag", perf_counter() - start
+    chunks = decode(path, channels(path))
+    if chunks is None:
+        return None, None, perf_counter() - start
+    powers = []
+    leftover = None
+    weights = None
+    try:
+        for rate, samples in chunks:
+            size = int(rate * SEGMENT)
+            if weights is None:
+                weights = k_weights(size, rate)
+            if leftover is not None:
+                samples = np.concatenate((leftover, samples))
+            usable = len(samples) - len(samples) % size
+            leftover = samples[usable:]
+            segments = samples[:usable].reshape(-1, size, samples.shape[1])
+            spectrum = np.abs(np.fft.rfft(segments, axis=1)) ** 2
+            powers.append((spectrum * weights[:, None]).sum(axis=(1, 2)))
+    except (OSError, EOFError, wave.Error):
+        return None, None, perf_counter() - start
+    loudness = integrated(np.concatenate(powers) if powers else np.zeros(0))
+    # Silence stays as it is
+    gain = 0.0 if loudness is None else REFERENCE - loudness
+    return round(float(gain), 2), "analysis", perf_counter() - start
+
+
+def effective_volume():
+    # pygame can't go any louder than 1, so gains above 0dB only help when
+    # the volume has been turned down
+    return min(Player.volume / 100 * Player.gain, 1.0)
+
+
+class Loudness:
+    # Per-track gain so songs mastered at different levels play at about
+    # the same loudness. ReplayGain tags are used if a track has them,
+    # otherwise it's analysed in a pool of processes (decoding and FFTs are
+    # CPU bound). Gains are cached in the metadata database. Analysis needs
+    # numpy, and ffmpeg for anything that isn't a WAV
+    _gains = {}  # str(path) -> gain in dB, None if it can't be worked out
+    _pending = set()
+    _futures = set()  # Analyses that haven't finished, for quit
+    _pool = None
+    _available = None
+
+    @classmethod
+    def available(cls):
+        if cls._available is None:
+            cls._available = find_spec("numpy") is not None
+        return cls._available
+
+    @classmethod
+    def pool(cls):
+        if cls._pool is None:
+            import multiprocessing
+            from concurrent.futures import ProcessPoolExecutor
+
+            # Forking a process with threads running (the metadata pool,
+            # the file watcher) can leave locks held in the child
+            cls._pool = ProcessPoolExecutor(
+                max_workers=WORKERS,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        return cls._pool
+
+    @classmethod
+    def known(cls, path):
+        # The gain if it's in memory or the cache, loading it into memory
+        path = str(path)
+        if path not in cls._gains:
+            cached = Metadata.gains([path])
+            if path not in cached:
+                return False
+            cls._gains[path] = cached[path]
+        return True
+
+    @classmethod
+    def gain(cls, path):
+        # The track's gain, or None if it isn't known yet (in which case
+        # it's analysed in the background for next time)
+        path = str(path)
+        if cls.known(path):
+            return cls._gains[path]
+        if path in cls._pending:
+            return None
+        gain = tag_gain(path)
+        if gain is not None:
+            Metadata.store_gain(path, stat_key(path), gain, "tag")
+            cls._gains[path] = gain
+            return gain
+        if not cls.available():
+            # Nothing is going to work it out, so don't read the tags again
+            # every time it's played
+            cls._gains[path] = None
+            return None
+        cls.analyze([path])
+        return None
+
+    @classmethod
+    def prepare(cls, path):
+        # Gets a song that's coming up ready without holding anything up
+        if not cls.known(path):
+            cls.analyze([path])
+
+    @classmethod
+    def analyze(cls, paths):
+        # Returns how many tracks were sent off to be analysed
+        if not cls.available():
+            return 0
+        paths = [
+            path
+            for path in map(str, paths)
+            if path not in cls._gains and path not in cls._pending
+        ]
+        cached = Metadata.gains(paths)
+        cls._gains.update(cached)
+        submitted = 0
+        for path in paths:
+            if path in cached:
+                continue
+            cls._pending.add(path)
+            future = cls.pool().submit(analyze, path)
+            cls._futures.add(future)
+            future.add_done_callback(cls._futures.discard)
+            future.add_done_callback(partial(cls._done, path))
+            submitted += 1
+        return submitted
+
+    @classmethod
+    def _done(cls, path, future):
+        # Runs on one of the pool's threads in this process
+        cls._pending.discard(path)
+        try:
+            gain, source, secs = future.result()
+        except Exception:
+            gain = None
+        cls._gains[path] = gain
+        if gain is None:
+            return
+        Metadata.store_gain(path, stat_key(path), gain, source)
+        if source == "analysis":
+            Stats.record("gain analysis", secs)
+            Stats.count("tracks analysed")
+
+    @classmethod
+    def pending(cls):
+        return len(cls._pending)
+
+    @classmethod
+    def apply(cls, path):
+        # Sets the volume for a song that's starting
+        gain = cls.gain(path) if Player.normalize else None
+        Player.gain = 1.0 if gain is None else 10 ** (gain / 20)
+        music.set_volume(effective_volume())
+
+    @classmethod
+    def quit(cls):
+        # shutdown can only cancel what's queued itself from Python 3.9
+        for future in list(cls._futures):
+            future.cancel()
+        if cls._pool is not None:
+            cls._pool.shutdown(wait=False)
@@ -1,4 +1,6 @@
 from pathlib import Path
+from prefix import PrefixIndex
+from lexer import parse, split, split_head
 from smp_common import autocomplete
 import json
 from player import Player
@@ -14,13 +16,16 @@ M_CMDS = {
 
 CMDS = {
     "config",
-    "eval",
-    "exit",
+    "dedupe",
     "delete",
+    "exec",
+    "exit",
+    "find",
     "forward",
     "help",
     "list",
     "loop",
+    "loudness",
     "ls",
     "macro",
     "pause",
@@ -31,11 +36,14 @@ CMDS = {
     "repeat",
     "rewind",
     "seek",
+    "stats",
     "stop",
     "time",
     "unpause",
     "volume",
 }
+_loaded = set()  # Macros that came from macros.json on the last reload
+_plans = {}  # Compiled macros, see compile_macro
 
 
 @command(Player)
@@ -46,9 +54,72 @@ def macro(*args):
         return
     cmd, *args = args
     if cmd in M_CMDS:
-        M_CMDS[cmd](*args)
-    else:
-        autocomplete(cmd, M_CMDS, *args)
+        return M_CMDS[cmd](*args)
+    return autocomplete(cmd, M_CMDS, *args)
+
+
+def macro_args(line):
+    # The arguments to `macro` in a whole line. A macro's body is kept as
+    # it was typed, so its quotes, escapes and semicolons still mean the
+    # same thing when it runs
+    words, body = split_head(line, 3)
+    if len(words) == 3 and body and resolve(words[1], M_CMDS) == "add":
+        return words[1:] + [body]
+    return split(line)[1:]
+
+
+def resolve(cmd, table):
+    if cmd in table:
+        return cmd
+    return PrefixIndex.of(table).unique(cmd)
+
+
+def plan(cmd, args, cmds, visiting=None):
+    # The (command, args) steps to run for one command: itself if it's a
+    # normal command in `cmds`, otherwise the compiled macro with any extra
+    # args going to its last step. Returns None if a macro ends up using
+    # itself
+    if command := resolve(cmd, cmds):
+        # Normal commands take precedence over macros
+        return [(command, args)]
+    mcr = resolve(cmd, Player.macros)
+    if mcr is None:
+        return [(cmd, args)]  # Left for autocomplete to deal with
+    steps = compile_macro(mcr, cmds, visiting)
+    if steps is None:
+        return None
+    if args and steps:
+        last, last_args = steps[-1]
+        steps = [*steps[:-1], (last, [*last_args, *args])]
+    return steps
+
+
+def compile_macro(name, cmds, visiting=None):
+    # Flattens a macro into the commands it runs, expanding the macros it
+    # uses along the way. The result is kept until the macros change
+    if name in _plans:
+        return _plans[name]
+    if visiting is None:
+        visiting = set()
+    if name in visiting:
+        return None
+    visiting.add(name)
+    steps = []
+    for command in parse(Player.macros[name]):
+        expanded = plan(command.name, command.args, cmds, visiting)
+        if expanded is None:
+            return None
+        steps.extend(expanded)
+    visiting.discard(name)
+    _plans[name] = steps
+    return steps
+
+
+def forget():
+    # Has to be called whenever macros are added, removed or reloaded.
+    # Other macros are matched by prefix, so any change can affect them
+    _plans.clear()
+    PrefixIndex.forget(Player.macros)
 
 
 def load_macros():
@@ -62,29 +133,53 @@ def load_macros():
             return json.load(f)
 
 
+def reload_macros():
+    # Picks up macros.json again, e.g. after it was edited by hand. Macros
+    # that were only defined in this session are kept
+    try:
+        saved = load_macros()
+    except ValueError:
+        print(f"Couldn't read {MACROS_PATH}, keeping the current macros")
+        return
+    session = {
+        name: body
+        for name, body in Player.macros.items()
+        if name not in _loaded
+    }
+    Player.macros = {**saved, **session}
+    _loaded.clear()
+    _loaded.update(saved)
+    forget()
+
+
 @command(Player, "macro add", requires_args=True)
 def add_macro(*args):
     mcr, *args = args
-    for arg in args:
-        if arg == mcr:
-            print("Recursive macros are not allowed")
-            return
-        if mcr in Player.macros.get(arg, []):
-            print("Cyclical macros are not allowed")
-            del Player.macros[arg]
-            return
     if mcr in CMDS:
         print("Macros can't be named existing commands")
-        return
+        return False
     if not args:
         print("Macro needs at least one argument")
-        return
+        return False
+    previous = Player.macros.get(mcr)
     Player.macros[mcr] = " ".join(args)
+    forget()
+    # Any cycle this creates has to go through the new macro, so compiling
+    # it is enough to catch them all
+    if compile_macro(mcr, CMDS) is None:
+        print("Recursive or cyclical macros are not allowed")
+        if previous is None:
+            del Player.macros[mcr]
+        else:
+            Player.macros[mcr] = previous
+        forget()
+        return False
 
 
 @command(Player, "macro delete", requires_args=True)
 def del_macro(*args):
     saved_macros = load_macros()
+    failed = False
     for arg in args:
         if arg in Player.macros:
             del Player.macros[arg]
@@ -92,8 +187,12 @@ def del_macro(*args):
                 del saved_macros[arg]
         else:
             print("Macro not found")
+            failed = True
+    forget()
     with open(MACROS_PATH, "w") as f:
         json.dump(saved_macros, f)
+    if failed:
+        return False
 
 
 @command(Player, "macro save", requires_args=True)
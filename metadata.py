@@ -0,0 +1,351 @@
+import os
+import sqlite3
+from pathlib import Path
+from queue import SimpleQueue
+from threading import Lock, Thread
+
+from stats import Stats
+
+CONFIG_DIR = Path("~/.config/smp").expanduser()
+CACHE_PATH = CONFIG_DIR / "cache.db"
+# Parsing is mostly waiting on the disk (or the network for NAS mounts),
+# so we can afford a lot more threads than cores
+WORKERS = min(32, 4 * (os.cpu_count() or 1))
+# Tags that are worth searching by
+SEARCH_TAGS = ("title", "artist", "album")
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tracks (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime INTEGER NOT NULL,
+    length REAL NOT NULL,
+    tags TEXT
+)
+"""
+# Frame offsets for seekindex, `points` being (time, offset) pairs packed
+# as doubles
+SEEK_SCHEMA = """
+CREATE TABLE IF NOT EXISTS seek_index (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime INTEGER NOT NULL,
+    header INTEGER NOT NULL,
+    points BLOB NOT NULL
+)
+"""
+# Track gains for loudness, `source` being "tag" or "analysis"
+LOUDNESS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS loudness (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime INTEGER NOT NULL,
+    gain REAL NOT NULL,
+    source TEXT NOT NULL
+)
+"""
+# Audio fingerprints for dedupe, packed 32 bit values
+FINGERPRINT_SCHEMA = """
+CREATE TABLE IF NOT EXISTS fingerprints (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime INTEGER NOT NULL,
+    data BLOB NOT NULL
+)
+"""
+SCHEMA_VERSION = 4
+
+
+def stat_key(path):
+    # A file whose size and mtime haven't changed is assumed to have the
+    # same contents, which is what keeps cache entries valid
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_size, st.st_mtime_ns
+
+
+def read_track(path):
+    # Returns the track's length and its searchable tags joined into one
+    # string. easy=True gives every format the same lowercase tag names.
+    # mutagen is imported here so startup doesn't have to wait for it
+    import mutagen
+
+    Stats.count("tracks parsed")
+    file = mutagen.File(path, easy=True)
+    tags = []
+    if file.tags is not None:
+        for key in SEARCH_TAGS:
+            try:
+                tags.extend(file.tags.get(key) or ())
+            except (KeyError, ValueError):
+                # Tag containers that aren't "easy" can be picky about keys
+                continue
+    return file.info.length, " ".join(map(str, tags))
+
+
+def try_read_track(path):
+    # Used in the background where there's nobody to report an exception
+    # to. A length of 0 just means the track won't count towards totals
+    try:
+        return read_track(path)
+    except Exception:
+        return 0, ""
+
+
+class Metadata:
+    # Persistent cache of track durations (and tags, for searching) so we
+    # only have to parse each file's header once, rather than every time
+    # it's played or loaded
+    _db = None
+    _lock = Lock()
+    _pool = None
+    _futures = set()  # Parses that haven't finished, for quit
+    generation = 0  # Goes up whenever tags are stored, for Search
+    results = SimpleQueue()  # (tag, path, length) from background fills
+
+    @classmethod
+    def connect(cls):
+        if cls._db is None:
+            if not CONFIG_DIR.exists():
+                CONFIG_DIR.mkdir(parents=True)
+            cls._db = sqlite3.connect(CACHE_PATH, check_same_thread=False)
+            cls._db.execute(SCHEMA)
+            cls._db.execute(SEEK_SCHEMA)
+            cls._db.execute(LOUDNESS_SCHEMA)
+            cls._db.execute(FINGERPRINT_SCHEMA)
+            (version,) = cls._db.execute("PRAGMA user_version").fetchone()
+            if version < 1:
+                # Caches from before tags were stored. Those rows keep a
+                # NULL until the file is next parsed
+                columns = cls._db.execute("PRAGMA table_info(tracks)")
+                if "tags" not in {column[1] for column in columns}:
+                    cls._db.execute("ALTER TABLE tracks ADD COLUMN tags TEXT")
+            cls._db.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+            cls._db.commit()
+        return cls._db
+
+    @classmethod
+    def duration(cls, path):
+        return cls.durations([path])[str(path)]
+
+    @classmethod
+    def durations(cls, paths, parser=read_track):
+        # Returns {str(path): length} for every path. Only files that are
+        # missing from the cache or have changed since are parsed. With
+        # try_read_track, files that can't be read get a length of 0 and
+        # aren't cached
+        lengths, stale = cls.cached(paths)
+        if stale:
+            parsed = dict(cls.parse(stale, parser))
+            for path, (length, _) in parsed.items():
+                lengths[path] = length
+            cls.store(
+                {p: (stat_key(p), *parsed[p]) for p in stale if parsed[p][0]}
+            )
+        return lengths
+
+    @classmethod
+    def cached(cls, paths):
+        # Like durations, but never parses anything. Returns the lengths
+        # we already know and a list of paths that still need parsing
+        keys = {str(path): stat_key(path) for path in paths}
+        cached = cls.lookup(keys)
+        lengths = {}
+        stale = []
+        for path, key in keys.items():
+            if key is not None and cached.get(path, (None,))[:2] == key:
+                lengths[path] = cached[path][2]
+            else:
+                stale.append(path)
+        return lengths, stale
+
+    @classmethod
+    def parse(cls, paths, parser=read_track):
+        # Yields (path, (length, tags)) in completion order, parsing on the
+        # worker pool when there's more than one file to get through
+        if len(paths) == 1:
+            yield paths[0], parser(paths[0])
+            return
+        from concurrent.futures import as_completed
+
+        futures = {cls.pool().submit(parser, path): path for path in paths}
+        cls._futures.update(futures)
+        for future in futures:
+            future.add_done_callback(cls._futures.discard)
+        for future in as_completed(futures):
+            if future.cancelled():
+                continue  # We're exiting
+            yield futures[future], future.result()
+
+    @classmethod
+    def fill(cls, paths, tag, done=None):
+        # Parses paths in the background, posting (tag, path, length) to
+        # Metadata.results as each one finishes and (tag, None, None) at
+        # the end, then calling done. Results are consumed on the main
+        # thread so nothing else has to worry about locking
+        def worker():
+            keys = {path: stat_key(path) for path in paths}
+            parsed = {}
+            for path, (length, tags) in cls.parse(paths, try_read_track):
+                cls.results.put((tag, path, length))
+                if length:
+                    parsed[path] = (keys[path], length, tags)
+                if len(parsed) >= 500:
+                    cls.store(parsed)
+                    parsed = {}
+            cls.store(parsed)
+            cls.results.put((tag, None, None))
+            if done is not None:
+                done()
+
+        Thread(target=worker, daemon=True).start()
+
+    @classmethod
+    def pool(cls):
+        if cls._pool is None:
+            # concurrent.futures pulls in logging, so it waits until
+            # there's something to parse
+            from concurrent.futures import ThreadPoolExecutor
+
+            cls._pool = ThreadPoolExecutor(
+                max_workers=WORKERS, thread_name_prefix="smp-metadata"
+            )
+        return cls._pool
+
+    @classmethod
+    def quit(cls):
+        # The pool's threads aren't daemons, so without this exiting waits
+        # for every parse that's still queued. shutdown can only cancel
+        # them itself from Python 3.9
+        for future in list(cls._futures):
+            future.cancel()
+        if cls._pool is not None:
+            cls._pool.shutdown(wait=False)
+
+    @classmethod
+    def lookup(cls, paths):
+        paths = list(paths)
+        rows = {}
+        with cls._lock:
+            db = cls.connect()
+            # Stay under SQLite's limit on the number of bound parameters
+            for i in range(0, len(paths), 500):
+                chunk = paths[i : i + 500]
+                placeholders = ", ".join("?" * len(chunk))
+                for path, size, mtime, length in db.execute(
+                    "SELECT path, size, mtime, length FROM tracks"
+                    f" WHERE path IN ({placeholders})",
+                    chunk,
+                ):
+                    rows[path] = (size, mtime, length)
+        return rows
+
+    @classmethod
+    def tags(cls):
+        # {path: tags} for every cached track that has any
+        with cls._lock:
+            db = cls.connect()
+            return dict(
+                db.execute("SELECT path, tags FROM tracks WHERE tags != ''")
+            )
+
+    @classmethod
+    def store(cls, entries):
+        # entries maps path -> ((size, mtime), length, tags). Files that
+        # disappeared while we were parsing them aren't worth caching
+        rows = [
+            (path, *key, length, tags)
+            for path, (key, length, tags) in entries.items()
+            if key is not None
+        ]
+        with cls._lock:
+            db = cls.connect()
+            db.executemany(
+                "INSERT OR REPLACE INTO tracks VALUES (?, ?, ?, ?, ?)", rows
+            )
+            db.commit()
+            if any(row[-1] for row in rows):
+                cls.generation += 1
+
+    @classmethod
+    def seek_index(cls, path, key):
+        # (header, points) stored for the file, if it hasn't changed since
+        with cls._lock:
+            db = cls.connect()
+            row = db.execute(
+                "SELECT size, mtime, header, points FROM seek_index"
+                " WHERE path = ?",
+                (str(path),),
+            ).fetchone()
+        if row is None or key is None or tuple(row[:2]) != key:
+            return None
+        return row[2], row[3]
+
+    @classmethod
+    def store_seek_index(cls, path, key, header, points):
+        if key is None:
+            return
+        with cls._lock:
+            db = cls.connect()
+            db.execute(
+                "INSERT OR REPLACE INTO seek_index VALUES (?, ?, ?, ?, ?)",
+                (str(path), *key, header, points),
+            )
+            db.commit()
+
+    @classmethod
+    def current(cls, table, column, paths):
+        # {str(path): column} from `table` for the paths whose file hasn't
+        # changed since their row was stored
+        keys = {str(path): stat_key(path) for path in paths}
+        paths = list(keys)
+        values = {}
+        with cls._lock:
+            db = cls.connect()
+            for i in range(0, len(paths), 500):
+                chunk = paths[i : i + 500]
+                placeholders = ", ".join("?" * len(chunk))
+                for path, size, mtime, value in db.execute(
+                    f"SELECT path, size, mtime, {column} FROM {table}"
+                    f" WHERE path IN ({placeholders})",
+                    chunk,
+                ):
+                    if keys[path] == (size, mtime):
+                        values[path] = value
+        return values
+
+    @classmethod
+    def gains(cls, paths):
+        return cls.current("loudness", "gain", paths)
+
+    @classmethod
+    def store_gain(cls, path, key, gain, source):
+        if key is None:
+            return
+        with cls._lock:
+            db = cls.connect()
+            db.execute(
+                "INSERT OR REPLACE INTO loudness VALUES (?, ?, ?, ?, ?)",
+                (str(path), *key, gain, source),
+            )
+            db.commit()
+
+    @classmethod
+    def fingerprints(cls, paths):
+        return cls.current("fingerprints", "data", paths)
+
+    @classmethod
+    def store_fingerprints(cls, entries):
+        # entries maps path -> ((size, mtime), fingerprint)
+        rows = [
+            (path, *key, data)
+            for path, (key, data) in entries.items()
+            if key is not None
+        ]
+        with cls._lock:
+            db = cls.connect()
+            db.executemany(
+                "INSERT OR REPLACE INTO fingerprints VALUES (?, ?, ?, ?)", rows
+            )
+            db.commit()
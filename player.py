@@ -1,28 +1,26 @@
 from pathlib import Path
-import mutagen
 
 
 class Player:
     # Global settings for the music player
     volume = 100
+    normalize = True  # Whether to apply each song's loudness gain
+    gain = 1.0  # Current song's loudness gain, as a volume multiplier
     loops = 0
     repeats = 0
     offset = 0
     duration = 0
-    queue = []
-    queue_info = {}
+    queue = None  # smp_queue.TrackQueue
+    info_pending = set()  # Songs whose durations are still being read
+    info_tag = 0
     macros = {}
     cur_song = Path()
-    shuffled_queue = []
     playing_queue = False
     should_pause = False
     q_idx = 0
     q_should_loop = False
     q_should_shuffle = False
-    awaiting_commands = True
-
-    @classmethod
-    def update_info(cls, song, settings):
-        cls.queue_info[song] = int(
-            mutagen.File(settings.music_dir / song).info.length
-        )
+    q_gapless = False
+    preloaded = None  # Song queued up in pygame to play next
+    spliced = False  # Whether pygame has a seekindex.SplicedFile loaded
+    last_pos = 0  # music.get_pos() when we last checked for a switch
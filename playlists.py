@@ -0,0 +1,188 @@
+import os
+
+from settings import Settings
+
+# Playlists are plain text with one song per line, so they can be read as
+# a stream and added to without rewriting the whole file. A song's line
+# may be preceded by an M3U style "#EXTINF:<seconds>," line holding its
+# length, which saves reading the song itself when the playlist is loaded.
+# Those and the header are the only lines that mean anything other than a
+# song, so songs can start with "#" too
+EXTENSION = ".smpl"
+HEADER = "#SMPL"
+LENGTH = "#EXTINF:"
+
+
+def playlist_path(name):
+    path = Settings.playlist_dir / f"{name}{EXTENSION}"
+    legacy = path.with_suffix(".csv")
+    if not path.exists() and legacy.exists():
+        migrate(legacy)
+    return path
+
+
+def migrate(legacy):
+    # Playlists used to be a single CSV row. Convert them to the new format
+    # the first time we come across them, keeping the original as a backup
+    import csv
+
+    with open(legacy, "r", newline="") as f:
+        reader = csv.reader(f, delimiter=",")
+        songs = next(iter(reader), [])
+    path = legacy.with_suffix(EXTENSION)
+    write_playlist(path, songs)
+    legacy.rename(legacy.with_suffix(".csv.bak"))
+    return path
+
+
+def migrate_all():
+    # Every legacy playlist that hasn't been converted yet
+    for legacy in Settings.playlist_dir.glob("*.csv"):
+        if not legacy.with_suffix(EXTENSION).exists():
+            migrate(legacy)
+
+
+def playlist_names():
+    migrate_all()
+    paths = Settings.playlist_dir.glob(f"*{EXTENSION}")
+    return sorted(path.stem for path in paths)
+
+
+def iter_playlist(path):
+    # Yields (song, length) for each entry, with a length of None when the
+    # playlist doesn't have one for that song
+    length = None
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.rstrip("\n")
+            if line.startswith(LENGTH):
+                try:
+                    length = int(line[len(LENGTH) :].partition(",")[0])
+                except ValueError:
+                    length = None
+            elif line and line != HEADER:
+                yield line, length
+                length = None
+
+
+def read_playlist(path):
+    return [song for song, _ in iter_playlist(path)]
+
+
+def format_entries(songs, lengths):
+    for song in songs:
+        if lengths and song in lengths:
+            yield f"{LENGTH}{lengths[song]},\n"
+        yield f"{song}\n"
+
+
+def write_playlist(path, songs, lengths=None):
+    # Written to a temporary file first, so a crash halfway through can't
+    # leave a playlist truncated
+    tmp = path.with_name(f".{path.name}.tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write(f"{HEADER}\n")
+        f.writelines(format_entries(songs, lengths))
+    os.replace(tmp, path)
+    Playlists.remember(path, songs)
+
+
+def append_playlist(path, songs, lengths=None):
+    # Adds songs to the end without touching what's already there
+    with open(path, "a", encoding="utf-8") as f:
+        f.writelines(format_entries(songs, lengths))
+    Playlists.forget(path)
+
+
+class Playlists:
+    # Which playlists each song is in, so renaming or deleting songs only
+    # has to touch the playlists that actually contain them. Playlists are
+    # only read again when their mtime changes
+    _dir = None
+    _entries = {}  # path -> (mtime, songs)
+    _index = {}  # song -> set of paths
+
+    @classmethod
+    def refresh(cls):
+        if Settings.playlist_dir != cls._dir:
+            cls._dir = Settings.playlist_dir
+            cls._entries = {}
+            cls._index = {}
+        migrate_all()
+        seen = set()
+        for path in Settings.playlist_dir.glob(f"*{EXTENSION}"):
+            seen.add(path)
+            mtime = path.stat().st_mtime_ns
+            entry = cls._entries.get(path)
+            if entry is None or entry[0] != mtime:
+                cls._add(path, mtime, read_playlist(path))
+        for path in cls._entries.keys() - seen:
+            cls._remove(path)
+
+    @classmethod
+    def containing(cls, songs):
+        # Returns {path: songs} for every playlist with any of the songs
+        cls.refresh()
+        found = {}
+        for song in songs:
+            for path in cls._index.get(song, ()):
+                found.setdefault(path, []).append(song)
+        return found
+
+    @classmethod
+    def update(cls, changes):
+        # changes maps songs to their new names, or to None if they should
+        # be removed. Each affected playlist is rewritten exactly once. A
+        # song that's replaced by one the playlist already has (dedupe)
+        # is dropped rather than listed twice
+        for path in cls.containing(changes):
+            entries = list(iter_playlist(path))
+            # Songs that keep their name, so a swap (a to b, b to a) isn't
+            # mistaken for a duplicate
+            listed = {
+                song for song, _ in entries if changes.get(song, song) == song
+            }
+            songs = []
+            lengths = {}
+            for song, length in entries:
+                new = changes.get(song, song)
+                if new is None:
+                    continue
+                if new != song:
+                    if new in listed:
+                        continue
+                    listed.add(new)
+                songs.append(new)
+                if length is not None:
+                    lengths[new] = length
+            write_playlist(path, songs, lengths)
+
+    @classmethod
+    def remember(cls, path, songs):
+        # Called after writing a playlist so we don't need to read it back
+        if cls._dir == path.parent:
+            cls._add(path, path.stat().st_mtime_ns, list(songs))
+
+    @classmethod
+    def forget(cls, path):
+        # Makes the next refresh read the playlist again
+        if path in cls._entries:
+            cls._remove(path)
+
+    @classmethod
+    def _add(cls, path, mtime, songs):
+        if path in cls._entries:
+            cls._remove(path)
+        cls._entries[path] = (mtime, songs)
+        for song in songs:
+            cls._index.setdefault(song, set()).add(path)
+
+    @classmethod
+    def _remove(cls, path):
+        _, songs = cls._entries.pop(path)
+        for song in songs:
+            paths = cls._index.get(song)
+            if paths is not None:
+                paths.discard(path)
+                if not paths:
+                    del cls._index[song]
@@ -0,0 +1,61 @@
+from bisect import bisect_left
+
+
+class PrefixIndex:
+    # Sorted keys searched with bisect, so looking up everything starting
+    # with a prefix costs O(log n) plus the number of matches
+    _tables = {}
+
+    def __init__(self, keys, presorted=False):
+        self.keys = keys if presorted else sorted(keys)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __contains__(self, key):
+        idx = bisect_left(self.keys, key)
+        return idx < len(self.keys) and self.keys[idx] == key
+
+    def span(self, prefix):
+        # Every key in keys[lo:hi] starts with prefix
+        lo = bisect_left(self.keys, prefix)
+        if not prefix:
+            return lo, len(self.keys)
+        last = ord(prefix[-1])
+        if last == 0x10FFFF:
+            hi = lo
+            while hi < len(self.keys) and self.keys[hi].startswith(prefix):
+                hi += 1
+            return lo, hi
+        # The first string that sorts after everything starting with prefix
+        hi = bisect_left(self.keys, prefix[:-1] + chr(last + 1), lo)
+        return lo, hi
+
+    def matches(self, prefix):
+        lo, hi = self.span(prefix)
+        return self.keys[lo:hi]
+
+    def count(self, prefix):
+        lo, hi = self.span(prefix)
+        return hi - lo
+
+    def unique(self, prefix):
+        # Exact matches win, otherwise the prefix has to be unambiguous.
+        # Returns None if there's no match or more than one
+        lo, hi = self.span(prefix)
+        if hi - lo == 1 or (hi > lo and self.keys[lo] == prefix):
+            return self.keys[lo]
+
+    @classmethod
+    def of(cls, table):
+        # Index over the keys of a command table (CMDS, Q_CMDS, macros...),
+        # built the first time it's needed. Tables that can change under
+        # us need to call forget when they do
+        cached = cls._tables.get(id(table))
+        if cached is None or cached[0] is not table:
+            cached = cls._tables[id(table)] = (table, cls(table))
+        return cached[1]
+
+    @classmethod
+    def forget(cls, table):
+        cls._tables.pop(id(table), None)
@@ -0,0 +1,96 @@
+import re
+from collections import defaultdict
+from heapq import nlargest
+
+from library import Library
+from metadata import Metadata
+from settings import Settings
+
+WORD = re.compile(r"[^\W_]+")
+
+
+def words(text):
+    return WORD.findall(text.lower())
+
+
+def trigrams(word):
+    # Padding lets short words and word boundaries count for something
+    padded = f" {word} "
+    return {padded[i : i + 3] for i in range(len(padded) - 2)}
+
+
+def humanize(song):
+    return song[: song.index(".")]
+
+
+class Search:
+    # Trigram inverted index over song names and their tags, so `find -f`
+    # can rank fuzzy matches without looking at every song
+    _version = None
+    _songs = []
+    _texts = []  # Lowercased name and tags for each song
+    _sizes = []  # Number of distinct trigrams for each song
+    _postings = {}
+
+    @classmethod
+    def build(cls):
+        songs = Library.refresh()
+        # Songs get their tags as the metadata cache fills in, which
+        # doesn't change the library
+        version = (Library.version, Metadata.generation)
+        if cls._version == version:
+            return
+        # Tags only come from the metadata cache, we don't go and read
+        # every file in the library just for this
+        tags = Metadata.tags()
+        texts = []
+        sizes = []
+        postings = defaultdict(list)
+        for idx, song in enumerate(songs):
+            text = humanize(song)
+            extra = tags.get(str(Settings.music_dir / song))
+            if extra:
+                text = f"{text} {extra}"
+            grams = set()
+            for word in words(text):
+                grams |= trigrams(word)
+            for gram in grams:
+                postings[gram].append(idx)
+            texts.append(" ".join(words(text)))
+            sizes.append(len(grams))
+        cls._songs = songs
+        cls._texts = texts
+        cls._sizes = sizes
+        cls._postings = dict(postings)
+        cls._version = version
+
+    @classmethod
+    def query(cls, text, limit=10):
+        # Returns up to `limit` songs, best match first
+        cls.build()
+        query_words = words(text)
+        grams = set()
+        for word in query_words:
+            grams |= trigrams(word)
+        if not grams:
+            return []
+        shared = defaultdict(int)
+        for gram in grams:
+            for idx in cls._postings.get(gram, ()):
+                shared[idx] += 1
+        scores = {}
+        for idx, count in shared.items():
+            # Dice coefficient, which doesn't punish long titles as much
+            # as a plain ratio of shared trigrams would
+            score = 2 * count / (len(grams) + cls._sizes[idx])
+            if all(word in cls._texts[idx] for word in query_words):
+                score += 1  # Every word appears as written
+            scores[idx] = score
+        # Anything sharing less than a third of the query is just noise
+        cutoff = len(grams) / 3
+        best = nlargest(
+            limit,
+            (idx for idx in scores if shared[idx] >= cutoff),
+            key=lambda idx: (scores[idx], -idx),
+        )
+        return [cls._songs[idx] for idx in best]
@@ -0,0 +1,351 @@
+import io
+import mmap
+import re
+from array import array
+from bisect import bisect_right
+from pathlib import Path
+from queue import SimpleQueue
+from threading import Thread
+from time import perf_counter
+
+from metadata import Metadata, stat_key
+from stats import Stats
+
+INTERVAL = 0.5  # Seconds between indexed frames
+MIN_LENGTH = 120  # Shorter songs seek fast enough without an index
+KEEP = 8  # Indexes kept in memory, for the songs played most recently
+# Kilobits per second by bitrate index, for MPEG 1 and MPEG 2/2.5 layer III
+MP3_BITRATES = {
+    True: (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),
+    False: (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+}
+# Sample rates by version bits (0 is MPEG 2.5, 2 is MPEG 2, 3 is MPEG 1)
+MP3_RATES = {
+    0: (11025, 12000, 8000),
+    2: (22050, 24000, 16000),
+    3: (44100, 48000, 32000),
+}
+FLAC_SYNC = re.compile(rb"\xff[\xf8\xf9]")
+
+
+def crc8_table():
+    table = []
+    for byte in range(256):
+        crc = byte
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x07 if crc & 0x80 else crc << 1) & 0xFF
+        table.append(crc)
+    return table
+
+
+CRC8 = crc8_table()
+
+
+def crc8(data):
+    crc = 0
+    for byte in data:
+        crc = CRC8[crc ^ byte]
+    return crc
+
+
+def id3_size(data):
+    # Length of the ID3v2 tag at the start of an MP3, if it has one
+    if data[:3] != b"ID3" or len(data) < 10:
+        return 0
+    # The size is "syncsafe", seven bits to a byte, and leaves out the
+    # 10 byte header
+    size = 0
+    for byte in data[6:10]:
+        size = size << 7 | byte & 0x7F
+    if data[5] & 0x10:
+        size += 10  # Footer
+    return size + 10
+
+
+def mp3_frame(data, pos):
+    # (length in bytes, samples, sample rate) of the layer III frame whose
+    # header starts at pos, or None if there isn't one
+    if pos + 4 > len(data) or data[pos] != 0xFF:
+        return None
+    b1, b2 = data[pos + 1], data[pos + 2]
+    version = (b1 >> 3) & 3
+    if b1 & 0xE0 != 0xE0 or version == 1 or (b1 >> 1) & 3 != 1:
+        return None
+    bitrate, rate = b2 >> 4, (b2 >> 2) & 3
+    if bitrate in (0, 15) or rate == 3:
+        return None
+    mpeg1 = version == 3
+    samples = 1152 if mpeg1 else 576
+    rate = MP3_RATES[version][rate]
+    bitrate = MP3_BITRATES[mpeg1][bitrate] * 1000
+    return samples // 8 * bitrate // rate + ((b2 >> 1) & 1), samples, rate
+
+
+def mp3_points(data):
+    # Walks the file frame by frame, which is the only way to know where
+    # a given time is in a VBR file
+    points = []
+    pos = id3_size(data)
+    time = 0.0
+    next_point = 0.0
+    first = True
+    synced = False
+    while pos < len(data):
+        frame = mp3_frame(data, pos)
+        if frame is not None and not synced:
+            # Random bytes can look like a header, so after junk only
+            # trust one that's followed by another
+            after = mp3_frame(data, pos + frame[0])
+            if after is None and pos + frame[0] < len(data):
+                frame = None
+        if frame is None:
+            synced = False
+            pos = data.find(b"\xff", pos + 1)
+            if pos < 0:
+                break
+            continue
+        synced = True
+        length, samples, rate = frame
+        # An encoder's Xing/Info frame at the start has no audio in it
+        if first and (
+            data.find(b"Xing", pos, pos + length) >= 0
+            or data.find(b"Info", pos, pos + length) >= 0
+        ):
+            first = False
+            pos += length
+            continue
+        first = False
+        if time >= next_point:
+            points.append((time, pos))
+            next_point = time + INTERVAL
+        time += samples / rate
+        pos += length
+    return points
+
+
+def flac_frame(data, pos):
+    # (frame or sample number, block size, whether it's a sample number)
+    # from the frame header at pos, or None if its CRC doesn't match
+    header = data[pos : pos + 16]
+    try:
+        block, rate = header[2] >> 4, header[2] & 0xF
+        if block == 0 or rate == 15 or header[3] >> 4 > 10 or header[3] & 1:
+            return None
+        # The number is coded like UTF-8, up to 7 bytes
+        number = header[4]
+        extra = 0
+        if number >= 0x80:
+            mask = 0x40
+            while mask and number & mask:
+                extra += 1
+                mask >>= 1
+            if not 1 <= extra <= 6:
+                return None
+            number &= mask - 1
+            for byte in header[5 : 5 + extra]:
+                if byte & 0xC0 != 0x80:
+                    return None
+                number = number << 6 | byte & 0x3F
+        end = 5 + extra
+        if block == 1:
+            size = 192
+        elif block <= 5:
+            size = 576 << (block - 2)
+        elif block == 6:
+            size = header[end] + 1
+            end += 1
+        elif block == 7:
+            size = int.from_bytes(header[end : end + 2], "big") + 1
+            end += 2
+        else:
+            size = 256 << (block - 8)
+        if rate == 12:
+            end += 1
+        elif rate in (13, 14):
+            end += 2
+        if crc8(header[:end]) != header[end]:
+            return None
+    except IndexError:
+        return None
+    return number, size, header[1] & 1
+
+
+def flac_points(data):
+    # Returns the length of the header (everything before the first frame)
+    # and the points. A frame is only taken if it carries on from the last
+    # one, which rules out sync codes that happen to be in the audio data
+    if data[:4] != b"fLaC":
+        return 0, []
+    pos = 4
+    rate = None
+    last = False
+    while not last and pos + 4 <= len(data):
+        last = data[pos] & 0x80
+        kind = data[pos] & 0x7F
+        size = int.from_bytes(data[pos + 1 : pos + 4], "big")
+        pos += 4
+        if kind == 0:  # STREAMINFO
+            rate = int.from_bytes(data[pos + 10 : pos + 13], "big") >> 4
+        pos += size
+    if not rate:
+        return 0, []
+    header = pos
+    points = []
+    expected = 0
+    step = None  # Block size of a fixed block size stream
+    next_point = 0.0
+    for match in FLAC_SYNC.finditer(data, header):
+        frame = flac_frame(data, match.start())
+        if frame is None:
+            continue
+        number, size, variable = frame
+        sample = number if variable else number * (step or size)
+        if sample != expected:
+            continue
+        if step is None:
+            step = size
+        time = sample / rate
+        if time >= next_point:
+            points.append((time, match.start()))
+            next_point = time + INTERVAL
+        expected = sample + size
+    return header, points
+
+
+def build(path):
+    # (header length, points) for the file, points being (time, offset)
+    with open(path, "rb") as f:
+        try:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            return 0, []  # Empty file
+        with data:
+            if Path(path).suffix.lower() == ".flac":
+                return flac_points(data)
+            return 0, mp3_points(data)
+
+
+class SplicedFile(io.RawIOBase):
+    # The first `header` bytes of a song followed by everything from
+    # `offset` on, which plays like a file that starts at the frame there.
+    # FLAC needs its header to be decoded at all; MP3 has none
+    def __init__(self, path, header, offset, skipped):
+        self.path = path
+        self.skipped = skipped  # Seconds of the song that were cut
+        self._file = open(path, "rb")
+        size = self._file.seek(0, io.SEEK_END)
+        self._segments = [(0, header), (offset, size - offset)]
+        self._size = header + size - offset
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, pos, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            pos += self._pos
+        elif whence == io.SEEK_END:
+            pos += self._size
+        self._pos = max(pos, 0)
+        return self._pos
+
+    def readinto(self, buffer):
+        done = 0
+        view = memoryview(buffer)
+        start = 0  # Where the current segment starts in the spliced file
+        for offset, length in self._segments:
+            if done == len(view):
+                break
+            into = self._pos - start
+            if 0 <= into < length:
+                self._file.seek(offset + into)
+                want = min(len(view) - done, length - into)
+                read = self._file.readinto(view[done : done + want])
+                done += read
+                self._pos += read
+            start += length
+        return done
+
+    def close(self):
+        self._file.close()
+        super().close()
+
+
+class SeekIndex:
+    # Where about every INTERVAL seconds of a long MP3 or FLAC starts in
+    # the file. Without it pygame seeks by decoding everything up to the
+    # new position (and for VBR MP3 it can land in the wrong place), so
+    # seeking an hour into a mix takes seconds. Indexes are built in the
+    # background the first time a song is played and cached in the
+    # metadata database
+    FORMATS = (".mp3", ".flac")
+    _points = {}  # str(path) -> (header, times, offsets)
+    _pending = set()
+    _jobs = SimpleQueue()
+    _worker = None
+
+    @classmethod
+    def prepare(cls, path, length):
+        if length < MIN_LENGTH or Path(path).suffix.lower() not in cls.FORMATS:
+            return
+        key = str(path)
+        if key in cls._points or key in cls._pending:
+            return
+        cls._pending.add(key)
+        cls._jobs.put(key)
+        if cls._worker is None:
+            cls._worker = Thread(
+                target=cls._work, name="smp-seekindex", daemon=True
+            )
+            cls._worker.start()
+
+    @classmethod
+    def _work(cls):
+        while True:
+            path = cls._jobs.get()
+            try:
+                cls._load(path)
+            except OSError:
+                pass
+            finally:
+                cls._pending.discard(path)
+
+    @classmethod
+    def _load(cls, path):
+        key = stat_key(path)
+        cached = Metadata.seek_index(path, key)
+        if cached is None:
+            start = perf_counter()
+            header, points = build(path)
+            flat = array("d", (n for point in points for n in point))
+            cached = header, flat.tobytes()
+            Metadata.store_seek_index(path, key, *cached)
+            Stats.record("seek index", perf_counter() - start)
+            Stats.count("seek indexes built")
+        header, data = cached
+        flat = array("d")
+        flat.frombytes(data)
+        while len(cls._points) >= KEEP:
+            cls._points.pop(next(iter(cls._points)))
+        cls._points[path] = (header, flat[::2], [int(n) for n in flat[1::2]])
+
+    @classmethod
+    def splice(cls, path, time):
+        # A file that starts at the last indexed frame at or before `time`,
+        # and the time it starts at. None if the song isn't indexed (yet)
+        # or `time` is too close to the start for it to matter
+        index = cls._points.get(str(path))
+        if index is None:
+            return None
+        header, times, offsets = index
+        idx = bisect_right(times, time) - 1
+        if idx <= 0:
+            return None
+        skipped = times[idx]
+        return SplicedFile(path, header, offsets[idx], skipped), skipped
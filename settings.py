@@ -74,7 +74,6 @@ def reload_cfg(startup=True):
 
 @command(Player)
 def config_wizard(*args):
-    Player.awaiting_commands = False
     empty_config = False
     if not CONFIG_PATH.exists():
         CONFIG_PATH.touch()
@@ -155,7 +154,6 @@ def config_wizard(*args):
         formatted_choices.extend(choice)
     CONFIG_PATH.write_text(CFG_TEMPLATE.format(*formatted_choices))
     print(f"New config saved at {CONFIG_PATH}")
-    Player.awaiting_commands = True
 
 
 class Settings:
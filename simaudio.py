@@ -0,0 +1,143 @@
+from pathlib import Path
+
+DEFAULT_LENGTH = 180.0  # seconds, for songs the backend wasn't told about
+
+
+class VirtualClock:
+    # Time that only moves when it's told to, so runs can be repeated
+    # exactly and don't take as long as the songs they play
+    def __init__(self, now=0.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, secs):
+        self.now += max(secs, 0)
+
+
+class SimulatedError(Exception):
+    pass
+
+
+class SimulatedBackend:
+    # An audio backend for audio.Audio.use that plays nothing, but keeps
+    # track of what pygame.mixer.music would be doing at any point on the
+    # clock: looping, switching to queued songs, pausing and get_pos all
+    # behave the same way. Every song starting, ending on its own or being
+    # stopped goes in `log` as (time, "start" | "end" | "stop", path)
+    def __init__(self, clock, lengths=None):
+        self.clock = clock
+        self.lengths = lengths or {}  # str(path) -> seconds
+        self.music = self
+        self.error = SimulatedError
+        self.log = []
+        self.volume = 1.0
+        self._loaded = None
+        self._queued = None
+        self._playing = False
+        self._paused_at = None
+        self._loops = 0  # Plays left after this one, -1 for forever
+        self._origin = 0.0  # When get_pos was 0, not counting pauses
+        self._segment = 0.0  # When the current play through started
+        self._start = 0.0  # Where in the song it started from
+
+    def _length(self, path):
+        # A seekindex.SplicedFile is missing the start of its song
+        source = getattr(path, "path", path)
+        length = self.lengths.get(str(source), DEFAULT_LENGTH)
+        return length - getattr(path, "skipped", 0)
+
+    def _log(self, time, kind):
+        path = getattr(self._loaded, "path", self._loaded)
+        self.log.append((time, kind, path))
+
+    def _update(self):
+        # Catches up on everything that would have happened by now
+        while self._playing and self._paused_at is None:
+            end = self._segment + self._length(self._loaded) - self._start
+            if self.clock() < end:
+                return
+            self._log(end, "end")
+            self._segment = end
+            self._start = 0.0
+            if self._loops:
+                if self._loops > 0:
+                    self._loops -= 1
+            elif self._queued is not None:
+                # pygame starts get_pos again from 0 for a queued song
+                self._loaded, self._queued = self._queued, None
+                self._origin = end
+            else:
+                self._playing = False
+                return
+            self._log(end, "start")
+
+    def load(self, path, namehint=""):
+        source = getattr(path, "path", path)
+        if str(source) not in self.lengths and not Path(source).exists():
+            raise SimulatedError(f"No file '{source}' found")
+        self.stop()
+        self._loaded = path
+        self._queued = None
+
+    def play(self, loops=0, start=0.0):
+        if self._loaded is None:
+            raise SimulatedError("music not loaded")
+        self.stop()
+        now = self.clock()
+        self._playing = True
+        self._paused_at = None
+        self._loops = loops
+        self._origin = self._segment = now
+        self._start = start
+        self._log(now, "start")
+
+    def queue(self, path):
+        self._update()
+        self._queued = path
+
+    def pause(self):
+        self._update()
+        if self._playing and self._paused_at is None:
+            self._paused_at = self.clock()
+
+    def unpause(self):
+        if self._paused_at is not None:
+            paused = self.clock() - self._paused_at
+            self._origin += paused
+            self._segment += paused
+            self._paused_at = None
+
+    def stop(self):
+        self._update()
+        if self._playing:
+            self._log(self.clock(), "stop")
+        self._playing = False
+        self._paused_at = None
+
+    def unload(self):
+        self.stop()
+        self._loaded = None
+        self._queued = None
+
+    def get_busy(self):
+        # Like pygame 2, a paused song doesn't count as busy
+        self._update()
+        return self._playing and self._paused_at is None
+
+    def get_pos(self):
+        self._update()
+        if not self._playing:
+            return -1
+        now = self._paused_at if self._paused_at is not None else self.clock()
+        return int((now - self._origin) * 1000)
+
+    def set_volume(self, volume):
+        self.volume = volume
+
+    def get_volume(self):
+        return self.volume
+
+    def quit(self):
+        self.unload()
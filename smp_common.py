@@ -1,39 +1,32 @@
-from pathlib import Path
+from library import Library
+from prefix import PrefixIndex
+from search import Search
 from settings import Settings
 
 
-def flatten(lst):
-    for elem in lst:
-        if isinstance(elem, list):
-            yield from flatten(elem)
-        else:
-            yield elem
-
-
 def gen_files():
-    return list(
-        map(
-            lambda f: Path(f).name,
-            flatten([
-                list(Settings.music_dir.glob(f"*.{ext}"))
-                for ext in SUPPORTED_TYPES
-            ]),
-        )
-    )
+    # Served from the library index, which only rescans the music
+    # directory when it has actually changed. The list is shared and
+    # already sorted, so callers shouldn't modify it
+    return Library.refresh()
 
 
 def autocomplete(cmd, cmd_set, *args):
+    # Returns whatever the command returned, or False if there wasn't one
+    # to run
     if Settings.autocomplete == 0:
         print("Autocomplete is disabled")
-        return
-    commands = [c for c in cmd_set if c.startswith(cmd)]
+        return False
+    commands = PrefixIndex.of(cmd_set).matches(cmd)
     if len(commands) == 1:
-        cmd_set[commands[0]](*args)
+        return cmd_set[commands[0]](*args)
     elif len(commands) == 0:
         print("Invalid command")
+        return False
     else:
         if Settings.autocomplete == 1:
             print(f"Ambiguous command, could be one of {', '.join(commands)}")
+            return False
         elif Settings.autocomplete == 2:
             for idx, command in enumerate(commands, start=1):
                 print(f"    {idx}: {command}")
@@ -42,12 +35,12 @@ def autocomplete(cmd, cmd_set, *args):
                 " leave blank to cancel: "
             )
             if not option:
-                return
+                return False
             while option not in map(str, range(1, len(commands) + 1)):
                 option = input(
                     f"Please enter a number from 1-{len(commands)}: "
                 )
-            cmd_set[commands[int(option) - 1]](*args)
+            return cmd_set[commands[int(option) - 1]](*args)
 
 
 def ac_songs(ac_level, song):
@@ -58,16 +51,23 @@ def ac_songs(ac_level, song):
             " in your config file."
         )
         return False
-    files = gen_files()
-    songs = [s for s in files if s.startswith(song)]
+    songs = Library.index().matches(song)
     if len(songs) == 1:
         return songs[0]
     elif len(songs) == 0:
-        print("Song not found")
-        return False
-    if ac_level == 1:
+        # Fall back to fuzzy matching in case of a typo or a word from
+        # the middle of the title, but never pick one on the user's behalf
+        songs = Search.query(song, limit=5)
+        if not songs:
+            print("Song not found")
+            return False
+        elif ac_level == 1:
+            print(f"Song not found, did you mean one of {', '.join(songs)}?")
+            return False
+        print("Song not found, closest matches are:")
+    elif ac_level == 1:
         print(f"Ambiguous song, could be one of {', '.join(songs)}")
-    elif ac_level == 2:
+    if ac_level == 2:
         for idx, song in enumerate(songs, start=1):
             print(f"    {idx}: {song}")
         option = input(
@@ -94,6 +94,3 @@ def type_converter(data, type_, err_msg):
         return type_(data)
     except ValueError:
         print(err_msg)
-
-
-SUPPORTED_TYPES = ["mp3", "ogg", "wav", "flac", "opus"]
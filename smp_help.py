@@ -1,3 +1,8 @@
+from time import perf_counter
+
+from stats import Stats
+
+
 def parametrized(dec):
     def layer(*args, **kwargs):
         def repl(f):
@@ -16,13 +21,21 @@ def command(func, player, topic=None, requires_args=False):
         has_args = len(args) > 0
         if not has_args:
             if requires_args:
+                # Asked to do something without saying what to do it to
                 ihelp(topic, player=player)
-                return
+                return False
         else:
             if args[0] in ("-h", "--help"):
                 ihelp(topic, player=player)
                 return
-        func(*args, **kwargs)
+        # Every command's wall time goes to `stats`. Commands return False
+        # when they couldn't do what they were asked, so scripts and -c
+        # can tell
+        start = perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            Stats.record(topic, perf_counter() - start)
 
     return inner
 
@@ -46,18 +59,15 @@ def ihelp(*topic, player):
     print("Type `list queue` to see the list of queue subcommands")
     print("Type `list macro` to see the list of macro subcommands")
     print("Type `tips` for a list of tips")
-    player.awaiting_commands = False
     while True:
         try:
             name = input(">>> ").lower().strip()
         except EOFError:
             print()
-            player.awaiting_commands = True
             return
         if not name:
             continue
         if name == "quit":
-            player.awaiting_commands = True
             return
         elif name == "list":
             print("\n".join(CMDS))
@@ -105,7 +115,8 @@ M_CMDS = {
 Creates a macro called `name` which expands to `args`
 when invoked. When creating a macro that expands to
 multiple commands, remember that they must be separated
-with a semicolon.""",
+with a semicolon. Macros can use other macros, but a macro
+that would end up using itself is rejected.""",
     "save": """Usage: macro save <*args>
 For each macro in `args`, attempts to save the macro
 in ~/.config/smp/macros.json. Will fail if the macro
@@ -136,22 +147,36 @@ song is not the first song.""",
     "loop": """Toggles whether the queue should loop. After the
 last song is finished, the queue will start from the start.""",
     "swap": """Swaps pairs of songs in the queue.""",
+    "gapless": """Toggles gapless playback. When on, the next song in the
+queue is loaded shortly before the current one ends, so it starts
+without a pause in between. Songs that are set to loop or repeat are
+never cut short by this.""",
     "shuffle": """Toggles between the shuffled queue and the
 normal queue. This command only shuffles the queue if it has
 not already been shuffled.""",
-    "randomize": """Randomizes the position of songs in the
-shuffled queue. This command also implies `queue shuffle` if
-the active queue is not the shuffled queue.""",
+    "randomize": """Usage: queue randomize [seed]
+Randomizes the position of songs in the shuffled queue. This
+command also implies `queue shuffle` if the active queue is not
+the shuffled queue. Giving the same seed shuffles the same queue
+the same way every time, and `queue status` shows the seed in use.""",
     "save": """Usage: queue save <filename>
-Saves the unshuffled queue to <filename>.csv in the playlists
-directory, overwriting it if it already exists.""",
+Saves the unshuffled queue to <filename>.smpl in the playlists
+directory, overwriting it if it already exists. If the queue only
+has songs added to the end since the playlist was saved, they're
+appended to it instead. Song lengths are saved along with the songs.
+Old .csv playlists are converted the first time they're used, and
+the original is kept as <filename>.csv.bak.""",
     "load": """Usage: queue load <filename>
-Loads the songs in <filename> into the current queue.""",
+Loads the songs in <filename> into the current queue. Lengths of songs
+that weren't saved in the playlist and haven't been seen before are read in the background, so you can
+start playing the queue straight away.""",
     "status": """Shows the previous song and the next song
 (if applicable). Also shows the current song being played,
 its index in the queue, the total length of the playlist,
 and total time elapsed as a timestamp.
-and a percentage. Only works if the queue is playing (paused is ok).""",
+and a percentage. Only works if the queue is playing (paused is ok).
+Right after `queue load`, song lengths may still be read in the
+background, in which case the total length is a lower bound.""",
     "find": """Usage: queue find <*songs> | <*indexes>
 For each song in songs, prints its position in the queue,
 and the songs that come immediately before and after it (if applicable).
@@ -185,12 +210,35 @@ decremented by that amount.
 Note that `level` must be between 0 and 100""",
     "ls": """Lists all songs in your music directory.
 To narrow your search, see `find`.""",
-    "find": """Usage: find <*substrs>
+    "find": """Usage: find <*substrs> | find -f <words>
 For each substring in `substrs`, lists all songs starting with that
-substring in alphabetical order.""",
+substring in alphabetical order.
+
+With -f (or --fuzzy), searches song names and tags for `words`, and
+lists the closest matches first. This tolerates typos and finds words
+from anywhere in the title, e.g. `find -f strwberry fields`.""",
     "loop": """Toggles loop mode for the current song.
 Note that when a new song is played, loop is automatically disabled,
 so this command only takes effect when a song is playing.""",
+    "loudness": """Usage: loudness [on | off | scan]
+Songs are played at about the same loudness, by turning each one
+up or down by its ReplayGain track gain. The gain comes from the
+song's tags if it has them, otherwise it's worked out in the
+background the first time the song is played (or just before,
+in a queue) and remembered from then on. Songs can only be turned
+up as far as the volume allows.
+
+With no arguments, shows the current song's gain. `on` and `off`
+turn normalization on or off, and `scan` works out the gain of
+every song in your music directory in the background.
+Working out gains needs numpy, and ffmpeg for anything but WAV.""",
+    "stats": """Usage: stats [reset | export <file>]
+Shows how long each command has taken over its last 256 runs,
+slowest first, along with how often the library was scanned and
+how many songs had to be read. `tick jitter` is how late smp woke
+up for the end of a song. `stats reset` clears everything, and
+`stats export <file>` appends every timing and counter to `file`
+as one JSON object per line.""",
     "time": """Shows time elapsed and time remaining for the current song.
 Will print `Nothing playing` if no song is being played.""",
     "rewind": """Usage: rewind <seconds>
@@ -207,7 +255,11 @@ to `rewind`.
 e.g. forward 90 = forward 1:30""",
     "seek": """Usage: seek <seconds>
 Sets the current time of the song to `seconds` after the start.
-`seconds` can either be a number or a timestamp.""",
+`seconds` can either be a number or a timestamp.
+
+MP3 and FLAC songs longer than two minutes are indexed in the
+background the first time they're played, after which seeking
+anywhere in them is instant.""",
     "pause": """Toggles whether the player is paused. Like `loop`,
 this only takes effect when a song is playing since the player is
 unpaused whenever a song starts playing.""",
@@ -238,6 +290,18 @@ until the song stops repeating.""",
 For each song in `songs`, deletes the song from the music directory
 and removes it from all playlists it's in. Use this over your operating
 system's tools for removing files or your playlists may break.""",
+    "dedupe": """Usage: dedupe [remove]
+Finds songs in your music directory that are the same recording
+under different names, even in different formats or bitrates, by
+comparing what the first minute of each sounds like. Lists each
+song that has duplicates, followed by its duplicates. The biggest
+file of each group is the one that's kept.
+
+`dedupe remove` deletes the duplicates like `delete` would, except
+playlists get the song that was kept in their place.
+
+The first run has to decode every song, after which only new or
+changed songs are. Needs numpy, and ffmpeg for anything but WAV.""",
     "rename": """Usage: rename <song> <new_name>
 Renames `song` to `new_name`, and applies this change to all playlists
 it's in. Specifying the extension is not necessary, as the renamed song
@@ -248,5 +312,8 @@ rename song1 name1 song2 name2 song3 name3 ...""",
     "exec": """Usage: exec <*scripts>
     For each script in scripts, read and execute the commands line by line.
     The scripts are processed in order, and the scripts are assumed to live at
-    ~/.config/smp/scripts""",
+    ~/.config/smp/scripts. Lines starting with # are ignored, and
+    consecutive `queue add` lines are added to the queue in one go.
+    Scripts never stop to ask you anything, so anything ambiguous or
+    anything that goes wrong is listed by line number at the end.""",
 }
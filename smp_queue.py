@@ -1,14 +1,341 @@
-from pygame.mixer import music
 from pathlib import Path
-from random import shuffle
-import csv
-import mutagen
+from queue import Empty
+from audio import music
+from collections.abc import Sequence
+from random import Random, getrandbits
+from events import Events
+from loudness import Loudness
+from metadata import Metadata
 from player import Player
+from seekindex import SeekIndex
+from playlists import (
+    append_playlist,
+    iter_playlist,
+    playlist_names,
+    playlist_path,
+    read_playlist,
+    write_playlist,
+)
 from settings import Settings
 import re
 from smp_common import autocomplete, timestamp, ac_songs, type_converter
 from smp_help import command
 
+PRELOAD_AHEAD = 5  # seconds
+# How long a song has to have been playing before the next one is queued
+# up behind it. check_switch spots the switch by get_pos going back down,
+# which it can't do if it was only just above 0 to start with
+MIN_PLAYED = 0.25  # seconds
+SHUFFLE_ROUNDS = 4
+
+
+class Fenwick:
+    # Running totals over a list of numbers, where updating a number or
+    # summing the first n both take O(log n)
+    def __init__(self, values=()):
+        self.tree = [0, *values]
+        for idx in range(1, len(self.tree)):
+            parent = idx + (idx & -idx)
+            if parent < len(self.tree):
+                self.tree[parent] += self.tree[idx]
+
+    def __len__(self):
+        return len(self.tree) - 1
+
+    def add(self, idx, delta):
+        idx += 1
+        while idx < len(self.tree):
+            self.tree[idx] += delta
+            idx += idx & -idx
+
+    def prefix(self, count):
+        # Sum of the first `count` values
+        count = min(count, len(self.tree) - 1)
+        total = 0
+        while count > 0:
+            total += self.tree[count]
+            count -= count & -count
+        return total
+
+    def append(self, value):
+        # The new node covers the `lowbit` values ending with this one
+        idx = len(self.tree)
+        self.tree.append(
+            value + self.prefix(idx - 1) - self.prefix(idx - (idx & -idx))
+        )
+
+
+class Permutation:
+    # A shuffled order of range(size) that's worked out one index at a time
+    # rather than stored. It's a small Feistel network, which shuffles all
+    # the numbers with a given number of bits, and anything that lands
+    # past the end is put through again until it doesn't ("cycle walking")
+    def __init__(self, size, seed):
+        self.size = size
+        self.seed = seed
+        self._half = max(1, ((size - 1).bit_length() + 1) // 2)
+        self._mask = (1 << self._half) - 1
+        rng = Random(seed)
+        self._keys = [rng.getrandbits(32) for _ in range(SHUFFLE_ROUNDS)]
+
+    def _round(self, value, key):
+        value = ((value ^ key) * 0x9E3779B1) & 0xFFFFFFFF
+        return (value ^ (value >> 15)) & self._mask
+
+    def _encrypt(self, value):
+        left, right = value >> self._half, value & self._mask
+        for key in self._keys:
+            left, right = right, left ^ self._round(right, key)
+        return (left << self._half) | right
+
+    def _decrypt(self, value):
+        left, right = value >> self._half, value & self._mask
+        for key in reversed(self._keys):
+            left, right = right ^ self._round(left, key), left
+        return (left << self._half) | right
+
+    def __getitem__(self, idx):
+        idx = self._encrypt(idx)
+        while idx >= self.size:
+            idx = self._encrypt(idx)
+        return idx
+
+    def index(self, value):
+        value = self._decrypt(value)
+        while value >= self.size:
+            value = self._decrypt(value)
+        return value
+
+
+class ShuffledView(Sequence):
+    # The shuffled queue, read straight out of the queue's order through a
+    # Permutation. Songs appended since the shuffle are past the end of the
+    # permutation and stay in the order they were added. A permutation of
+    # None leaves the order as it is
+    def __init__(self, order, perm):
+        self.order = order
+        self.perm = perm
+
+    def __len__(self):
+        return len(self.order)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self[i] for i in range(*idx.indices(len(self)))]
+        if idx < 0:
+            idx += len(self.order)
+        if not 0 <= idx < len(self.order):
+            raise IndexError("queue index out of range")
+        if self.perm is not None and idx < self.perm.size:
+            idx = self.perm[idx]
+        return self.order[idx]
+
+    def index_of(self, pos):
+        # Where the song at `pos` in the queue's order is in this view
+        if self.perm is not None and pos < self.perm.size:
+            return self.perm.index(pos)
+        return pos
+
+
+class TrackQueue:
+    # The queue in order together with its shuffled view. The position of
+    # every song in both is kept in a dict, so membership and position
+    # lookups don't have to scan the lists. Song lengths are kept in a
+    # Fenwick tree per view, so total and elapsed time are O(log n).
+    # The shuffled view starts out as a ShuffledView, so shuffling a big
+    # queue costs nothing until something other than an append changes the
+    # order, at which point it's turned into a list like the queue itself
+    def __init__(self, songs=()):
+        self.load(songs)
+
+    def __len__(self):
+        return len(self.order)
+
+    def __iter__(self):
+        return iter(self.order)
+
+    def __contains__(self, song):
+        return song in self._pos
+
+    def load(self, songs, lengths=None):
+        # A song can only be in the queue once
+        self.order = list(dict.fromkeys(songs))
+        self._pos = {song: idx for idx, song in enumerate(self.order)}
+        self.shuffled = ShuffledView(self.order, None)
+        self._shuffled_pos = None  # Only once the view is a list
+        self.seed = None
+        self._same_order = True
+        self.lengths = dict(lengths or {})  # Only for songs we've read
+        self._totals = None
+        self._shuffled_totals = None
+
+    def clear(self):
+        self.load(())
+
+    def view(self, shuffled=False):
+        # The list itself, not a copy, so don't modify it
+        return self.shuffled if shuffled else self.order
+
+    def index(self, song, shuffled=False):
+        # Raises KeyError if the song isn't queued
+        if not shuffled:
+            return self._pos[song]
+        if self._shuffled_pos is None:
+            return self.shuffled.index_of(self._pos[song])
+        return self._shuffled_pos[song]
+
+    def is_shuffled(self):
+        # Whether the shuffled view is in a different order to the queue
+        return not self._same_order
+
+    def set_length(self, song, length):
+        # Only for songs that are in the queue
+        delta = length - self.lengths.get(song, 0)
+        self.lengths[song] = length
+        if self._totals is not None:
+            self._totals.add(self._pos[song], delta)
+        if self._shuffled_totals is not None:
+            self._shuffled_totals.add(self.index(song, True), delta)
+
+    def total(self):
+        return self._view_totals(False).prefix(len(self.order))
+
+    def elapsed(self, count, shuffled=False):
+        # Combined length of the first `count` songs in the given view
+        return self._view_totals(shuffled).prefix(count)
+
+    def _view_totals(self, shuffled):
+        # The trees are thrown away by changes that move lots of songs
+        # around and only rebuilt when they're next needed
+        if shuffled:
+            if self._shuffled_totals is None:
+                self._shuffled_totals = self._build_totals(self.shuffled)
+            return self._shuffled_totals
+        if self._totals is None:
+            self._totals = self._build_totals(self.order)
+        return self._totals
+
+    def _build_totals(self, songs):
+        return Fenwick(self.lengths.get(song, 0) for song in songs)
+
+    def append(self, song):
+        self._pos[song] = len(self.order)
+        self.order.append(song)
+        # A ShuffledView already ends with whatever was appended
+        if self._shuffled_pos is not None:
+            self._shuffled_pos[song] = len(self.shuffled)
+            self.shuffled.append(song)
+        length = self.lengths.get(song, 0)
+        for totals in (self._totals, self._shuffled_totals):
+            if totals is not None:
+                totals.append(length)
+
+    def remove(self, songs):
+        # Removing everything at once means one pass over the lists no
+        # matter how many songs go
+        songs = {song for song in songs if song in self._pos}
+        if not songs:
+            return
+        self._materialize()
+        start = min(self._pos[song] for song in songs)
+        self.order[start:] = [s for s in self.order[start:] if s not in songs]
+        self._reindex(self.order, self._pos, start)
+        start = min(self._shuffled_pos[song] for song in songs)
+        self.shuffled[start:] = [
+            s for s in self.shuffled[start:] if s not in songs
+        ]
+        self._reindex(self.shuffled, self._shuffled_pos, start)
+        for song in songs:
+            del self._pos[song]
+            del self._shuffled_pos[song]
+            self.lengths.pop(song, None)
+        self._totals = None
+        self._shuffled_totals = None
+
+    def insert(self, idx, song):
+        # Moves the song to idx if it's already queued, otherwise adds it.
+        # Only the unshuffled order is affected, new songs go on the end of
+        # the shuffled view like they do with append
+        self._materialize()
+        if song in self._pos:
+            old = self._pos[song]
+            del self.order[old]
+            self.order.insert(idx, song)
+            self._reindex(self.order, self._pos, min(old, idx))
+        else:
+            self.order.insert(idx, song)
+            self._reindex(self.order, self._pos, idx)
+            self._shuffled_pos[song] = len(self.shuffled)
+            self.shuffled.append(song)
+            if self._shuffled_totals is not None:
+                self._shuffled_totals.append(self.lengths.get(song, 0))
+        self._totals = None
+        self._same_order = self.order == self.shuffled
+
+    def swap(self, first, second):
+        # Swaps two queued songs in the unshuffled order
+        self._materialize()
+        idx1, idx2 = self._pos[first], self._pos[second]
+        self.order[idx1], self.order[idx2] = second, first
+        self._pos[first], self._pos[second] = idx2, idx1
+        if self._totals is not None:
+            delta = self.lengths.get(first, 0) - self.lengths.get(second, 0)
+            self._totals.add(idx1, -delta)
+            self._totals.add(idx2, delta)
+        if first != second:
+            self._same_order = False
+
+    def randomize(self, seed=None):
+        # Picks a new order for the shuffled view without going through
+        # the songs. The same seed gives the same order for the same queue,
+        # even if that's the order it's already in. Without a seed the
+        # order has to actually change, so there need to be at least two
+        # songs
+        given = seed is not None
+        if not given:
+            seed = getrandbits(32)
+        while True:
+            perm = Permutation(len(self.order), seed)
+            view = ShuffledView(self.order, perm)
+            # Usually settled by the first song or two
+            if given or any(a != b for a, b in zip(view, self.shuffled)):
+                break
+            seed += 1
+        self.shuffled = view
+        self._shuffled_pos = None
+        self.seed = seed
+        self._shuffled_totals = None
+        self._same_order = False
+
+    def _materialize(self):
+        # Turns a ShuffledView into a list before the order gets changed
+        # underneath it
+        if self._shuffled_pos is None:
+            self.shuffled = list(self.shuffled)
+            self._shuffled_pos = {
+                song: idx for idx, song in enumerate(self.shuffled)
+            }
+
+    @staticmethod
+    def _reindex(songs, positions, start):
+        for idx in range(start, len(songs)):
+            positions[songs[idx]] = idx
+
+
+Player.queue = TrackQueue()
+
+
+def active_queue():
+    # The list songs are played from, shuffled or not
+    return Player.queue.view(Player.q_should_shuffle)
+
+
+def prepare_next():
+    # Works out the next song's gain while this one plays, so it's ready
+    # by the time the next one starts
+    if Player.q_idx < len(Player.queue):
+        Loudness.prepare(Settings.music_dir / active_queue()[Player.q_idx])
+
 
 def should_advance():
     # checks if we should play the next song in the queue
@@ -20,6 +347,117 @@ def should_advance():
             return False
 
 
+def can_preload():
+    # Preloading only works if nothing else needs to happen when the
+    # current song ends. We also don't preload across the end of the queue
+    # since a shuffled queue gets reshuffled there
+    return (
+        Player.q_gapless
+        and Player.playing_queue
+        and Player.preloaded is None
+        and Player.loops == 0
+        and Player.repeats == 0
+        and Player.q_idx < len(Player.queue)
+    )
+
+
+def preload_wakeup(remaining):
+    # Seconds until the next song should be preloaded, or None if it
+    # doesn't need to be. Waiting until near the end leaves time for
+    # `repeat` or `loop` to change what happens next
+    if can_preload():
+        played = music.get_pos() / 1000
+        return max(remaining - PRELOAD_AHEAD, MIN_PLAYED - played, 0)
+
+
+def preload(remaining):
+    # Queues the next song in pygame so it starts the moment the current
+    # one finishes, instead of after the main loop notices it has
+    if (
+        can_preload()
+        and remaining <= PRELOAD_AHEAD
+        and music.get_pos() / 1000 >= MIN_PLAYED
+    ):
+        song = active_queue()[Player.q_idx]
+        music.queue(Settings.music_dir / song)
+        Player.preloaded = song
+        Player.last_pos = music.get_pos()
+
+
+def check_switch():
+    # pygame resets get_pos when it starts the queued song, which is the
+    # only way to tell it has. Anything else that restarts playback
+    # also has to reset Player.last_pos so it isn't mistaken for this
+    if Player.preloaded is None:
+        return
+    pos = music.get_pos()
+    if music.get_busy() and pos < Player.last_pos:
+        Player.cur_song = Settings.music_dir / Player.preloaded
+        Player.duration = Metadata.duration(Player.cur_song)
+        Player.offset = 0
+        Player.q_idx += 1
+        Player.preloaded = None
+        Player.spliced = False
+        SeekIndex.prepare(Player.cur_song, Player.duration)
+        Loudness.apply(Player.cur_song)
+        prepare_next()
+    Player.last_pos = pos
+
+
+def cancel_preload():
+    # pygame can't take a song off its queue, it only drops it when loading
+    # another song. So load the current one again and carry on from where
+    # it was
+    if Player.preloaded is None:
+        return
+    time = (music.get_pos() / 1000 + Player.offset) % Player.duration
+    music.load(Player.cur_song)
+    music.play(Player.loops, time)
+    Player.offset = time
+    Player.last_pos = 0
+    Player.preloaded = None
+    Player.spliced = False
+    if Player.should_pause:
+        music.pause()
+
+
+def recheck_preload():
+    # For after the queue changes, when the song pygame has queued up
+    # might not be the one that comes next any more
+    if Player.preloaded is None:
+        return
+    queue = active_queue()
+    if Player.q_idx >= len(queue) or queue[Player.q_idx] != Player.preloaded:
+        cancel_preload()
+
+
+def apply_info(reprompt=False):
+    # Picks up durations that `queue load` is reading in the background.
+    # reprompt is for when the user is sitting at the prompt
+    while True:
+        try:
+            tag, path, length = Metadata.results.get_nowait()
+        except Empty:
+            return
+        if tag != Player.info_tag:
+            continue  # Left over from a queue that's since been replaced
+        if path is None:
+            if Player.info_pending:
+                # Anything still pending must have been removed and
+                # re-added in the meantime, so we won't hear about it
+                Player.info_pending.clear()
+            if reprompt:
+                print("\nFinished reading song info for the queue")
+                print(end=Settings.prompt, flush=True)
+            else:
+                print("Finished reading song info for the queue")
+            continue
+        name = Path(path).name
+        if name in Player.info_pending:
+            Player.info_pending.remove(name)
+            Player.queue.set_length(name, int(length))
+
+
 @command(Player)
 def queue(*args):
     if not args:
@@ -27,9 +465,8 @@ def queue(*args):
         return
     cmd, *args = args
     if cmd in Q_CMDS:
-        Q_CMDS[cmd](*args)
-    else:
-        autocomplete(cmd, Q_CMDS, *args)
+        return Q_CMDS[cmd](*args)
+    return autocomplete(cmd, Q_CMDS, *args)
 
 
 def num_as_position(num):
@@ -49,44 +486,45 @@ def num_as_position(num):
 
 
 def show():
-    if Player.q_should_shuffle:
-        humanized = [song[: song.index(".")] for song in Player.shuffled_queue]
-    else:
-        humanized = [song[: song.index(".")] for song in Player.queue]
+    humanized = [song[: song.index(".")] for song in active_queue()]
     print(", ".join(humanized))
 
 
 @command(Player, "queue find")
 def find(*args):
-    if Player.q_should_shuffle:
-        queue = Player.shuffled_queue
-    else:
-        queue = Player.queue
+    queue = active_queue()
     if not queue:
         print("No songs in the queue")
-        return
-    humanized = [song[: song.index(".")] for song in queue]
+        return False
     if not args:
         args = [Player.cur_song.name]
         if not Player.cur_song.name:
             print("Nothing playing")
-            return
+            return False
+    failed = False
     for arg in args:
         if arg.isdigit():
             # User is searching for the nth song instead of a title
             arg = int(arg)
             if arg > len(queue) or arg < 1:
                 print(f"Please enter a valid position between 1-{len(queue)}")
+                failed = True
                 continue
             idx = arg - 1
             song = queue[idx]
         else:
             song = ac_songs(Settings.autocomplete, arg)
         if not song:
+            failed = True
             continue
-        if song in queue:
-            idx = queue.index(song)
-            humanized[idx] = f"\x1b[4m\x1b[1m{humanized[idx]}\x1b[0m"
+        if song in Player.queue:
+            idx = Player.queue.index(song, Player.q_should_shuffle)
+            # Only the songs around it get printed
+            start = max(idx - 5, 0)
+            humanized = [s[: s.index(".")] for s in queue[start : idx + 6]]
+            humanized[idx - start] = (
+                f"\x1b[4m\x1b[1m{humanized[idx - start]}\x1b[0m"
+            )
             idx_as_pos = num_as_position(idx + 1)
             if len(queue) == 1:
                 print(f"{Path(song).stem} is 1st in the queue")
@@ -112,28 +550,27 @@ def find(*args):
                         f" before {next}, and after {prev}"
                     )
                 print()
-                print(
-                    f'...{", ".join(humanized[max(idx - 5, 0) : idx + 6])}...'
-                )
+                print(f'...{", ".join(humanized)}...')
         else:
             print(f"{song} is not in the queue")
+            failed = True
+    if failed:
+        return False
 
 
 @command(Player, "queue status")
 def status(*args):
-    total_time = sum(Player.queue_info.values())
+    apply_info()
+    total_time = Player.queue.total()
     cur_time = music.get_pos() / 1000 + Player.offset
     if not Player.playing_queue:
         print("Nothing playing")
         return
     else:
         time = cur_time % Player.duration
-    if Player.q_should_shuffle:
-        queue = Player.shuffled_queue
-    else:
-        queue = Player.queue
-    elapsed_time = sum(
-        Player.queue_info[name] for name in queue[: Player.q_idx - 1]
+    queue = active_queue()
+    elapsed_time = Player.queue.elapsed(
+        Player.q_idx - 1, Player.q_should_shuffle
     )
     cur_song = Path(Player.cur_song).stem
     if len(queue) == 1:
@@ -150,57 +587,107 @@ def status(*args):
 
     print(f"Previous song: {prev_song}, next song: {next_song}")
     print(f"Currently playing {cur_song} ({Player.q_idx}/{len(queue)})")
-    print(f"Total length of playlist: {timestamp(total_time)}")
-    print(
-        f"Total time elapsed: {timestamp(int(elapsed_time + time))} "
-        f"({100 * ((elapsed_time + time) / total_time):.1f}%)"
-    )
+    if Player.q_should_shuffle and Player.queue.seed is not None:
+        print(f"Shuffled with seed {Player.queue.seed}")
+    if Player.info_pending:
+        # Only a lower bound until every song has been read
+        print(
+            f"Total length of playlist: at least {timestamp(total_time)}"
+            f" (still reading {len(Player.info_pending)}/{len(queue)} songs)"
+        )
+        print(f"Total time elapsed: {timestamp(int(elapsed_time + time))}")
+    else:
+        print(f"Total length of playlist: {timestamp(total_time)}")
+        print(
+            f"Total time elapsed: {timestamp(int(elapsed_time + time))} "
+            f"({100 * ((elapsed_time + time) / total_time):.1f}%)"
+        )
 
 
 @command(Player, "queue insert", requires_args=True)
 def insert(*args):
     if len(args) % 2 != 0:
         print("Expected an even number of arguments")
-        return
+        return False
+    failed = False
     for i in range(0, len(args), 2):
         song, index = args[i], args[i + 1]
         song = ac_songs(Settings.autocomplete, song)
         index = type_converter(index, int, "Index must be a whole number")
         if index is None:
-            return
-        if index not in range(1, len(Player.queue) + 1):
+            return False
+        if index not in range(1, len(Player.queue) + 2):
             print(
-                f"Index must be a number between 1-{len(Player.queue) + 1}, not {index}"
+                f"Index must be a number between 1-{len(Player.queue) + 1},"
+                f" not {index}"
             )
-            return
-        index -= 1
-        if song not in Player.queue:
-            Player.queue.remove(song)
-        Player.queue.insert(index, song)
+            return False
+        if not song:
+            failed = True
+            continue
+        is_new = song not in Player.queue
+        Player.queue.insert(index - 1, song)
+        recheck_preload()
+        if is_new:
+            update_info([song])
+    if failed:
+        return False
 
 
 @command(Player, "queue clear")
 def clear(*args):
     Player.q_idx = 0
     Player.queue.clear()
-    Player.shuffled_queue.clear()
     Player.playing_queue = False
-    Player.queue_info = {}
+    Player.info_pending = set()
+    Player.info_tag += 1
+    recheck_preload()
     # Bad things would happen if we tried to advance
     # and the queue was suddenly empty
 
 
 @command(Player, "queue add", requires_args=True)
 def add(*args):
+    added = []
+    failed = False
     for arg in args:
         song = ac_songs(Settings.autocomplete, arg)
-        if song:
-            if song in Player.queue:
-                print("That song is already in the queue")
-                return
+        if not song:
+            failed = True
+            continue
+        if song in Player.queue:
+            print("That song is already in the queue")
+            failed = True
+            break
+        Player.queue.append(song)
+        added.append(song)
+    update_info(added)
+    if failed:
+        return False
+
+
+def enqueue(songs):
+    # Bulk version of `queue add` for songs that are already resolved.
+    # Returns the songs that were already queued and got skipped
+    added = []
+    skipped = []
+    for song in songs:
+        if song in Player.queue:
+            skipped.append(song)
+        else:
             Player.queue.append(song)
-            Player.shuffled_queue.append(song)
-            Player.update_info(song, Settings)
+            added.append(song)
+    update_info(added)
+    return skipped
+
+
+def update_info(songs):
+    # Read all the durations in one go so they can be parsed in parallel
+    lengths = Metadata.durations(Settings.music_dir / song for song in songs)
+    for song in songs:
+        length = int(lengths[str(Settings.music_dir / song)])
+        Player.queue.set_length(song, length)
+        Player.info_pending.discard(song)
 
 
 @command(Player, "queue next")
@@ -210,6 +697,7 @@ def qnext(*args):
             print("Nothing queued")
         else:
             print("Either end of queue already reached or nothing playing")
+        return False
     else:
         music.stop()
         music.unload()
@@ -224,11 +712,13 @@ def prev(*args):
             print("Nothing queued")
         else:
             print("Either end of queue already reached or nothing playing")
+        return False
     elif Player.q_idx > 1:
         Player.q_idx -= 2
         play()
     else:
         print("Can't go back any further")
+        return False
 
 
 @command(Player, "queue loop")
@@ -237,131 +727,175 @@ def loop(*args):
     print(f"Queue loop: {'on' if Player.q_should_loop else 'off'}")
 
 
+@command(Player, "queue gapless")
+def gapless(*args):
+    Player.q_gapless ^= True
+    if not Player.q_gapless:
+        cancel_preload()
+    print(f"Gapless playback: {'on' if Player.q_gapless else 'off'}")
+
+
 @command(Player, "queue randomize")
 def randomize(*args):
-    if not Player.shuffled_queue:
-        print("Nothing to randomize")
-        return
-    elif len(Player.shuffled_queue) == 1:
+    if len(Player.queue) < 2:
         print("Nothing to randomize")
-        return
-    initial = [*Player.shuffled_queue]
-    while Player.shuffled_queue == initial:
-        shuffle(Player.shuffled_queue)
+        return False
+    seed = None
+    if args:
+        seed = type_converter(args[0], int, "The seed has to be a number")
+        if seed is None:
+            return False
+    Player.queue.randomize(seed)
     Player.q_should_shuffle = True
+    recheck_preload()
 
 
 @command(Player, "queue shuffle")
 def qshuffle(*args):
     Player.q_should_shuffle ^= True
-    if Player.queue == Player.shuffled_queue:
+    if not Player.queue.is_shuffled():
         randomize()
+    recheck_preload()
 
 
 @command(Player, "queue play")
 def play(*args):
     if not Player.queue:
         print("Nothing queued")
-        return
+        return False
     if Player.q_idx == len(Player.queue):
         Player.q_idx = 0
         if Player.q_should_shuffle:
             randomize()
     Player.playing_queue = True
-    if not Player.q_should_shuffle:
-        Player.cur_song = Settings.music_dir / Player.queue[Player.q_idx]
-    else:
-        Player.cur_song = (
-            Settings.music_dir / Player.shuffled_queue[Player.q_idx]
-        )
+    Player.cur_song = Settings.music_dir / active_queue()[Player.q_idx]
     song = Player.cur_song
     music.load(song)
+    Player.preloaded = None
+    Player.spliced = False
     Player.loops = 0
     Player.offset = 0
     Player.should_pause = False
-    file = mutagen.File(song)
-    Player.duration = file.info.length
+    Player.duration = Metadata.duration(song)
+    SeekIndex.prepare(song, Player.duration)
+    Loudness.apply(song)
     music.play()
     if Player.q_idx < len(Player.queue):
         Player.q_idx += 1
+    prepare_next()
 
 
 @command(Player, "queue save", requires_args=True)
 def save(*args):
-    file = args[0]
-    with open(f"{Settings.playlist_dir}/{file}.csv", "w", newline="") as f:
-        writer = csv.writer(f, delimiter=",")
-        writer.writerow(Player.queue)
+    path = playlist_path(args[0])
+    songs = Player.queue.view(False)
+    if path.exists():
+        saved = read_playlist(path)
+        # Saving a queue that has only grown since it was loaded just adds
+        # the new songs instead of writing everything out again
+        if len(saved) <= len(songs) and songs[: len(saved)] == saved:
+            append_playlist(path, songs[len(saved) :], Player.queue.lengths)
+            return
+    write_playlist(path, songs, Player.queue.lengths)
 
 
 @command(Player, "queue load")
 def load(*args):
     if not args:
         print("Playlists:")
-        for f in Settings.playlist_dir.glob("*"):
-            print(f.stem)
+        for name in playlist_names():
+            print(name)
         return
-    file = args[0]
-    if not Path.exists(Path(f"{Settings.playlist_dir}/{file}.csv")):
+    path = playlist_path(args[0])
+    if not path.exists():
         print("That playlist doesn't exist")
-        return
-    with open(f"{Settings.playlist_dir}/{file}.csv", "r", newline="") as f:
-        reader = csv.reader(f, delimiter=",")
-        Player.queue = next(iter(reader))
-        Player.shuffled_queue = [*Player.queue]
-    Player.queue_info = {
-        name: int(mutagen.File(Settings.music_dir / name).info.length)
-        for name in Player.queue
-    }
+        return False
+    songs = []
+    lengths = {}
+    missing = []
+    for song, length in iter_playlist(path):
+        songs.append(song)
+        if length is not None:
+            lengths[song] = length
+        else:
+            missing.append(song)
+    # Lengths saved in the playlist and cached durations are available
+    # straight away. Anything else is read in the background so the queue
+    # can start playing in the meantime
+    cached, stale = Metadata.cached(
+        Settings.music_dir / name for name in missing
+    )
+    for song, length in cached.items():
+        lengths[Path(song).name] = int(length)
+    Player.queue.load(songs, lengths)
+    Player.info_pending = {Path(path).name for path in stale}
+    Player.info_tag += 1
+    if stale:
+        print(f"Reading song info for {len(stale)} songs in the background")
+        Metadata.fill(stale, Player.info_tag, lambda: Events.post(Events.INFO))
     Player.q_idx = 0
+    recheck_preload()
 
 
 @command(Player, "queue remove", requires_args=True)
 def remove(*args):
+    songs = set()
+    failed = False
     for arg in args:
         arg = ac_songs(Settings.autocomplete, arg)
         if arg in Player.queue:
-            idx = Player.queue.index(arg)
-            Player.queue.remove(arg)
-            Player.shuffled_queue.remove(arg)
-            del Player.queue_info[arg]
-            if Player.playing_queue and idx < Player.q_idx:
-                Player.q_idx -= 1
+            songs.add(arg)
         else:
             print("That song is not in the queue")
+            failed = True
+    drop(songs)
+    if failed:
+        return False
+
+
+def drop(songs):
+    # Removes songs we already know are queued, without any autocomplete
+    songs = set(songs)
+    if Player.playing_queue:
+        Player.q_idx -= sum(
+            Player.queue.index(song, Player.q_should_shuffle) < Player.q_idx
+            for song in songs
+        )
+    Player.queue.remove(songs)
+    for song in songs:
+        Player.info_pending.discard(song)
+    recheck_preload()
 
 
 @command(Player, "queue swap", requires_args=True)
 def swap(*args):
     if len(args) % 2 != 0:
         print("Expected an even number of arguments")
-        return
+        return False
+    failed = False
     for i in range(0, len(args), 2):
         first, second = args[i], args[i + 1]
-        if first in Player.queue and second in Player.queue:
-            idx1, idx2 = Player.queue.index(first), Player.queue.index(second)
-            Player.queue[idx1], Player.queue[idx2] = (
-                Player.queue[idx2],
-                Player.queue[idx1],
-            )
-        else:
+        if first not in Player.queue or second not in Player.queue:
             first = ac_songs(Settings.autocomplete, first)
             second = ac_songs(Settings.autocomplete, second)
-            if first and second:
-                idx1, idx2 = (
-                    Player.queue.index(first),
-                    Player.queue.index(second),
-                )
-                Player.queue[idx1], Player.queue[idx2] = (
-                    Player.queue[idx2],
-                    Player.queue[idx1],
-                )
+            if not (first and second):
+                failed = True
+                continue
+            if first not in Player.queue or second not in Player.queue:
+                print("Both songs need to be in the queue")
+                failed = True
+                continue
+        Player.queue.swap(first, second)
+    recheck_preload()
+    if failed:
+        return False
 
 
 Q_CMDS = {
     "add": lambda *args: add(*args),
     "clear": lambda *args: clear(*args),
     "find": lambda *args: find(*args),
+    "gapless": lambda *args: gapless(*args),
     "insert": lambda *args: insert(*args),
     "load": lambda *args: load(*args),
     "loop": lambda *args: loop(*args),
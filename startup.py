@@ -0,0 +1,30 @@
+import sys
+from time import perf_counter
+
+# Modules that are deliberately left until they're needed
+DEFERRED = ("pygame", "mutagen", "concurrent.futures", "readline", "csv")
+
+
+class Startup:
+    # Where the time goes between launching smp and the first prompt, for
+    # --startup-profile. Imported first so "imports" covers everything else
+    _last = perf_counter()
+    _phases = []
+
+    @classmethod
+    def mark(cls, phase):
+        # Everything since the last mark is put down to `phase`
+        now = perf_counter()
+        cls._phases.append((phase, now - cls._last))
+        cls._last = now
+
+    @classmethod
+    def report(cls):
+        print("Startup profile:")
+        for phase, secs in cls._phases:
+            print(f"    {phase:<12} {secs * 1000:8.1f} ms")
+        total = sum(secs for _, secs in cls._phases)
+        print(f"    {'total':<12} {total * 1000:8.1f} ms")
+        deferred = [name for name in DEFERRED if name not in sys.modules]
+        if deferred:
+            print(f"Not loaded yet: {', '.join(deferred)}")
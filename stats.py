@@ -0,0 +1,81 @@
+import json
+from collections import deque
+from threading import Lock
+from time import time
+
+SAMPLES = 256  # Timings kept per name, older ones are dropped
+
+
+def json_line(**fields):
+    return json.dumps(fields) + "\n"
+
+
+class Stats:
+    # Timings and counters for finding slow paths. Timings go in a fixed
+    # size ring buffer per name, so keeping them costs the same however
+    # long smp runs. Counters can be bumped from worker threads
+    _timings = {}  # name -> deque of (unix time, seconds)
+    _calls = {}  # name -> total number of timings, including dropped ones
+    _counters = {}
+    _lock = Lock()
+
+    @classmethod
+    def record(cls, name, secs):
+        samples = cls._timings.get(name)
+        if samples is None:
+            samples = cls._timings.setdefault(name, deque(maxlen=SAMPLES))
+        samples.append((time(), secs))
+        cls._calls[name] = cls._calls.get(name, 0) + 1
+
+    @classmethod
+    def count(cls, name, amount=1):
+        with cls._lock:
+            cls._counters[name] = cls._counters.get(name, 0) + amount
+
+    @classmethod
+    def reset(cls):
+        cls._timings = {}
+        cls._calls = {}
+        with cls._lock:
+            cls._counters = {}
+
+    @classmethod
+    def summary(cls):
+        # name -> (calls, mean, median, 95th percentile, max) in seconds,
+        # worked out from the samples still in the buffer
+        summary = {}
+        for name, samples in list(cls._timings.items()):
+            secs = sorted(sample for _, sample in samples)
+            if not secs:
+                continue
+            summary[name] = (
+                cls._calls[name],
+                sum(secs) / len(secs),
+                secs[len(secs) // 2],
+                secs[min(len(secs) - 1, int(len(secs) * 0.95))],
+                secs[-1],
+            )
+        return summary
+
+    @classmethod
+    def counters(cls):
+        with cls._lock:
+            return dict(cls._counters)
+
+    @classmethod
+    def export(cls, path):
+        # One JSON object per line, every timing still in the buffers
+        # followed by the counters
+        with open(path, "a", encoding="utf-8") as f:
+            for name, samples in list(cls._timings.items()):
+                for at, secs in list(samples):
+                    f.write(
+                        json_line(
+                            type="timing", name=name, time=at, seconds=secs
+                        )
+                    )
+            now = time()
+            for name, value in cls.counters().items():
+                f.write(
+                    json_line(type="counter", name=name, time=now, value=value)
+                )
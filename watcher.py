@@ -0,0 +1,115 @@
+import ctypes
+import ctypes.util
+import os
+import struct
+from sys import platform
+from threading import Thread, Timer
+from time import sleep
+
+from events import Events
+
+# From <sys/inotify.h>
+IN_CLOSE_WRITE = 0x008
+IN_MOVED_FROM = 0x040
+IN_MOVED_TO = 0x080
+IN_DELETE = 0x200
+IN_CLOEXEC = 0o2000000
+INOTIFY_EVENT = struct.Struct("iIII")
+POLL_INTERVAL = 2  # seconds, only used when inotify isn't available
+# Editors that save by replacing the file leave it missing for a moment,
+# so wait this long before deciding it's really gone
+MISSING_GRACE = 5  # seconds
+
+
+def file_key(path):
+    try:
+        st = path.stat()
+    except FileNotFoundError:
+        return None
+    return st.st_ino, st.st_size, st.st_mtime_ns
+
+
+class Watcher:
+    # Posts Events.FILE with the path as payload whenever one of the
+    # watched files changes. If a file goes missing and stays missing, the
+    # event is posted anyway so the handler can decide what to do
+    _keys = {}
+    _missing = set()  # Files we're waiting on before calling them missing
+
+    @classmethod
+    def start(cls, *paths):
+        cls._keys = {path: file_key(path) for path in paths}
+        if platform == "linux":
+            fd = cls._inotify(paths)
+            if fd is not None:
+                watch = Thread(target=cls._watch_inotify, args=(fd,))
+                watch.daemon = True
+                watch.start()
+                return
+        watch = Thread(target=cls._watch_stat)
+        watch.daemon = True
+        watch.start()
+
+    @classmethod
+    def _changed(cls, path):
+        # Several notifications can arrive for one save, and some don't
+        # change anything at all. Only tell the main loop about real changes
+        key = file_key(path)
+        if key is None:
+            if path not in cls._missing and cls._keys.get(path) is not None:
+                cls._missing.add(path)
+                check = Timer(MISSING_GRACE, cls._check_missing, (path,))
+                # Nothing to check once we're exiting
+                check.daemon = True
+                check.start()
+            return
+        if key != cls._keys.get(path):
+            cls._keys[path] = key
+            Events.post(Events.FILE, path)
+
+    @classmethod
+    def _check_missing(cls, path):
+        cls._missing.discard(path)
+        if file_key(path) is None:
+            cls._keys[path] = None
+            Events.post(Events.FILE, path)
+
+    @classmethod
+    def _inotify(cls, paths):
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+            fd = libc.inotify_init1(IN_CLOEXEC)
+        except (OSError, AttributeError):
+            return None
+        if fd < 0:
+            return None
+        # Watching the directories rather than the files themselves means
+        # we still see files that get replaced by a rename
+        mask = IN_CLOSE_WRITE | IN_MOVED_TO | IN_MOVED_FROM | IN_DELETE
+        for directory in {path.parent for path in paths}:
+            if libc.inotify_add_watch(fd, bytes(directory), mask) < 0:
+                os.close(fd)
+                return None
+        return fd
+
+    @classmethod
+    def _watch_inotify(cls, fd):
+        names = {path.name: path for path in cls._keys}
+        while True:
+            buf = os.read(fd, 4096)
+            offset = 0
+            while offset < len(buf):
+                _, _, _, length = INOTIFY_EVENT.unpack_from(buf, offset)
+                offset += INOTIFY_EVENT.size
+                name = buf[offset : offset + length].rstrip(b"\0")
+                offset += length
+                path = names.get(os.fsdecode(name))
+                if path is not None:
+                    cls._changed(path)
+
+    @classmethod
+    def _watch_stat(cls):
+        while True:
+            sleep(POLL_INTERVAL)
+            for path in list(cls._keys):
+                cls._changed(path)